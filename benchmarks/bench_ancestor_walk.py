@@ -0,0 +1,104 @@
+"""Benchmark the cost per step of walking up the ancestors of a dataset.
+
+Run with
+
+    python benchmarks/bench_ancestor_walk.py [--depth N] [--repeat N]
+
+A chain of datasets is published to the caches as if `index()` had fetched it, so no
+database is needed. Only the root has the type that is looked for, so every lookup walks
+the whole chain. Three walks are timed per step: one comparing the state type models
+(`Dataset.type`), one comparing the type IDs set at index time (`Dataset.type_id`) and
+`closest_ancestor_of_type`, which also remembers the answer for every step.
+"""
+
+import argparse
+import datetime
+import time
+
+from chimedb.dataset import get
+from chimedb.dataset.forest import DatasetForest
+
+TYPES = ["frequencies", "flags"]
+
+
+def chain(depth):
+    """Make a chain of datasets, the root of type 0 and all others of type 1."""
+    ids = [f"{i:032x}" for i in range(depth)]
+    time = datetime.datetime(2020, 1, 1)
+    return DatasetForest.build(
+        ids=ids,
+        base_ids=[""] + ids[:-1],
+        root=[True] + [False] * (depth - 1),
+        time=[time] * depth,
+        ds_state_ids=[f"s{i:031x}" for i in range(depth)],
+        ds_type_ids=[0] + [1] * (depth - 1),
+        types=dict(enumerate(TYPES)),
+    )
+
+
+def walk_types(d, type_):
+    """Walk up from `d` comparing the state type models."""
+    while d:
+        if d.type == type_:
+            return d
+        d = d.base_dataset
+
+
+def walk_type_ids(d, type_id):
+    """Walk up from `d` comparing the state type IDs."""
+    while d:
+        if d.type_id == type_id:
+            return d
+        d = d.base_dataset
+
+
+def best_time(func, repeat):
+    """Call `func` `repeat` times and return the shortest time in s."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--depth", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    datasets, states, types = get._models_from_forest(chain(args.depth))
+    get._publish(datasets, states, types)
+    leaf = get.Dataset.from_id(f"{args.depth - 1:032x}")
+    type_ = get.DatasetStateType.from_name(TYPES[0])
+    assert walk_types(leaf, type_).root and walk_type_ids(leaf, type_.id).root
+
+    def lookup():
+        # without the remembered answers of the previous lookup
+        get._closest_cache.clear()
+        leaf.closest_ancestor_of_type(type_)
+
+    leaf.closest_ancestor_of_type(type_)
+    sibling = get.Dataset.from_id(f"{args.depth - 2:032x}")
+    t_remembered = best_time(
+        lambda: sibling.closest_ancestor_of_type(type_), args.repeat
+    )
+
+    timings = {
+        "Dataset.type ==": best_time(lambda: walk_types(leaf, type_), args.repeat),
+        "Dataset.type_id ==": best_time(
+            lambda: walk_type_ids(leaf, type_.id), args.repeat
+        ),
+        "closest_ancestor_of_type": best_time(lookup, args.repeat),
+    }
+
+    print(f"{args.depth} deep chain, best of {args.repeat}")
+    for name, t in timings.items():
+        print(f"{name:26s} {t * 1e9 / args.depth:8.0f} ns per step")
+    print(f"{'remembered lookup':26s} {t_remembered * 1e9:8.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
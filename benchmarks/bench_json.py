@@ -0,0 +1,93 @@
+"""Benchmark decoding state data with the available JSON codecs.
+
+Run with
+
+    python benchmarks/bench_json.py [--repeat N]
+
+Synthetic states with the size and structure of real frequency, input and product
+states are encoded once and then decoded through `StateDataField` with every JSON
+library that is installed.
+"""
+
+import argparse
+import time
+
+from chimedb.dataset import orm
+
+
+def frequency_state(nfreq=1024):
+    """Make a state listing `nfreq` frequency channels."""
+    return {
+        "type": "frequencies",
+        "data": [[i, [800.0 - i * 0.390625, 0.390625]] for i in range(nfreq)],
+    }
+
+
+def input_state(ninput=2048):
+    """Make a state listing `ninput` correlator inputs."""
+    return {
+        "type": "inputs",
+        "data": [
+            [i, f"FCC{i // 256:02d}{(i // 16) % 16:02d}{i % 16:02d}"]
+            for i in range(ninput)
+        ],
+    }
+
+
+def product_state(nfeed=256):
+    """Make a state listing the products of `nfeed` feeds."""
+    return {
+        "type": "products",
+        "data": [[i, j] for i in range(nfeed) for j in range(i, nfeed)],
+    }
+
+
+STATES = {
+    "frequencies": frequency_state,
+    "inputs": input_state,
+    "products": product_state,
+}
+
+
+def bench(codec, encoded, repeat):
+    """Decode `encoded` `repeat` times, return the best time per decode in s."""
+    orm.set_json_codec(codec)
+    field = orm.DatasetState.data
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        field.python_value(encoded)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    codecs = []
+    for name in orm.JSON_CODECS:
+        try:
+            orm.set_json_codec(name)
+            codecs.append(name)
+        except ImportError:
+            print(f"{name} not installed, skipping.")
+
+    print(
+        f"{'state':<12} {'size':>10} " + " ".join(f"{c + ' MB/s':>14}" for c in codecs)
+    )
+    for state, make_state in STATES.items():
+        orm.set_json_codec("json")
+        encoded = orm.DatasetState.data.db_value(make_state())
+        size = len(encoded)
+        rates = [size / bench(codec, encoded, args.repeat) / 1e6 for codec in codecs]
+        print(
+            f"{state:<12} {size / 1e3:>8.0f}kB "
+            + " ".join(f"{rate:>14.1f}" for rate in rates)
+        )
+
+
+if __name__ == "__main__":
+    main()
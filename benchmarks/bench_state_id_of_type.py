@@ -0,0 +1,104 @@
+"""Benchmark `state_ids_of_types` with and without an indexed forest.
+
+Run with
+
+    python benchmarks/bench_state_id_of_type.py [--datasets N] [--ids N]
+
+A synthetic forest is published as if `index(compact=True)` had fetched it, and the
+caches are filled as if `index()` had, so no database is needed. The vectorised lookup
+through the forest is compared to the python walk over the cached datasets.
+"""
+
+import argparse
+import datetime
+import time
+
+import numpy as np
+
+from chimedb.dataset import get, utils
+from chimedb.dataset.forest import DatasetForest
+
+TYPES = ["frequencies", "inputs", "products", "flags", "gating"]
+
+
+def synthetic_forest(n, ntrees=100, seed=0):
+    """Trees starting with a chain of all types, with random branches below."""
+    rng = np.random.default_rng(seed)
+    ids = [f"{i:032x}" for i in range(n)]
+    base = [""] * n
+    type_ids = np.zeros(n, dtype=np.int32)
+    tree_nodes = [[] for _ in range(ntrees)]
+    for i in range(n):
+        tree = i % ntrees
+        nodes = tree_nodes[tree]
+        if len(nodes) < len(TYPES):
+            # the chain of all types
+            type_ids[i] = len(nodes)
+            if nodes:
+                base[i] = ids[nodes[-1]]
+        else:
+            type_ids[i] = rng.integers(len(TYPES))
+            base[i] = ids[nodes[rng.integers(len(TYPES) - 1, len(nodes))]]
+        nodes.append(i)
+
+    time = datetime.datetime(2020, 1, 1)
+    return DatasetForest.build(
+        ids=ids,
+        base_ids=base,
+        root=[b == "" for b in base],
+        time=[time] * n,
+        ds_state_ids=[f"s{i:031x}" for i in range(n)],
+        ds_type_ids=type_ids,
+        types=dict(enumerate(TYPES)),
+    )
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--datasets", type=int, default=100000)
+    parser.add_argument("--ids", type=int, default=1000000)
+    parser.add_argument("--types", type=int, default=1, help="Number of types to get.")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    types = TYPES[: args.types]
+
+    forest = synthetic_forest(args.datasets)
+    rng = np.random.default_rng(1)
+    ds_ids = forest.ids[rng.integers(len(forest), size=args.ids)].astype("U32")
+    ds_ids[rng.random(args.ids) < 0.01] = utils.NULL_DATASET
+
+    # Fill the caches like index() would, with empty state data
+    datasets, states, type_models = get._models_from_forest(forest)
+    for state in states.values():
+        state.__data__["data"] = dict()
+    get._publish(datasets, states, type_models)
+
+    start = time.perf_counter()
+    slow = utils._state_ids_by_walking(ds_ids, types)
+    t_slow = time.perf_counter() - start
+
+    get._publish_forest(forest)
+    start = time.perf_counter()
+    forest.closest_ancestor_table(0)
+    t_table = time.perf_counter() - start
+
+    # best of a few runs: the first one is dominated by page faults allocating the
+    # output arrays
+    t_fast = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        fast = utils.state_ids_of_types(ds_ids, types)
+        t_fast = min(t_fast, time.perf_counter() - start)
+
+    for name in types:
+        assert (fast[name] == slow[name]).all()
+
+    print(f"{args.ids} IDs, {args.datasets} datasets, {len(types)} types")
+    print(f"python walk:     {t_slow:8.3f} s")
+    print(f"forest:          {t_fast:8.3f} s ({t_slow / t_fast:.0f}x)")
+    print(f"ancestor table:  {t_table:8.3f} s (once per type and index)")
+
+
+if __name__ == "__main__":
+    main()
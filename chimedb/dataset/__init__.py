@@ -1,7 +1,13 @@
 """comet (datasets and states) table definitions."""
 
 from .get import DatasetState, Dataset, DatasetStateType
-from .insert import insert_dataset, insert_state
+from .insert import (
+    InsertQueue,
+    insert_dataset,
+    insert_datasets,
+    insert_state,
+    insert_states,
+)
 
 # deprecated
 from .get import get_dataset, get_state
@@ -17,8 +23,11 @@ __all__ = [
     "Dataset",
     "DatasetState",
     "DatasetStateType",
+    "InsertQueue",
     "insert_dataset",
+    "insert_datasets",
     "insert_state",
+    "insert_states",
     "get_dataset",
     "get_state",
     "__version__",
@@ -0,0 +1,315 @@
+"""Bounded caches used to keep datasets, states and types in memory."""
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import sys
+import threading
+import time
+
+
+def approx_sizeof(obj):
+    """Estimate the memory used by a (JSON-like) python object in bytes.
+
+    Parameters
+    ----------
+    obj
+        Any object. Dicts, lists, tuples and sets are traversed recursively.
+
+    Returns
+    -------
+    int
+        Approximate size in bytes.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += approx_sizeof(k) + approx_sizeof(v)
+    elif isinstance(obj, (list, tuple, set)):
+        for v in obj:
+            size += approx_sizeof(v)
+    return size
+
+
+class _Flight:
+    """A load of a cache entry in progress that other threads can wait for."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class LRUCache(MutableMapping):
+    """A thread-safe dict with optional size limits, LRU eviction and expiry of entries.
+
+    Parameters
+    ----------
+    max_entries : int, optional
+        Maximum number of entries. Unlimited if `None`.
+    max_bytes : int, optional
+        Maximum total size of all entries as reported by `sizeof`. Unlimited if `None`.
+    ttl : float, optional
+        Time in seconds after which an entry expires. Never if `None`.
+    sizeof : callable, optional
+        Function returning the (approximate) size of a value in bytes. Only used if
+        `max_bytes` is set. Default: :func:`approx_sizeof`.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, sizeof=None):
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._loading = dict()
+        self.max_bytes = None
+        self.sizeof = sizeof or approx_sizeof
+        self.configure(max_entries, max_bytes, ttl)
+
+    @property
+    def lock(self):
+        """The lock protecting the cache. Hold it to make several operations atomic."""
+        return self._lock
+
+    def configure(self, max_entries=None, max_bytes=None, ttl=None):
+        """Change the limits of the cache.
+
+        Entries exceeding the new limits are evicted immediately.
+
+        Parameters
+        ----------
+        max_entries : int, optional
+            Maximum number of entries. Unlimited if `None`.
+        max_bytes : int, optional
+            Maximum total size of all entries in bytes. Unlimited if `None`.
+        ttl : float, optional
+            Time in seconds after which an entry expires. Never if `None`.
+        """
+        with self._lock:
+            if max_bytes is not None and self.max_bytes is None:
+                # sizes were not tracked until now
+                for key, (value, _, expires) in self._data.items():
+                    self._data[key] = (value, self.sizeof(value), expires)
+                self._bytes = sum(size for _, size, _ in self._data.values())
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+            self._evict()
+
+    @property
+    def nbytes(self):
+        """Approximate total size of all entries (only tracked if max_bytes is set)."""
+        return self._bytes
+
+    def _expired(self, expires):
+        return expires is not None and expires < time.monotonic()
+
+    def _evict(self):
+        """Remove least recently used entries until the limits are respected."""
+        while self._data and (
+            (self.max_entries is not None and len(self._data) > self.max_entries)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            _, (_, size, _) = self._data.popitem(last=False)
+            self._bytes -= size
+
+    def __getitem__(self, key):
+        with self._lock:
+            value, size, expires = self._data[key]
+            if self._expired(expires):
+                del self._data[key]
+                self._bytes -= size
+                raise KeyError(key)
+            self._data.move_to_end(key)
+            return value
+
+    def get(self, key, default=None):
+        """Get an entry or `default`, without raising KeyError for missing entries."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, size, expires = entry
+            if self._expired(expires):
+                del self._data[key]
+                self._bytes -= size
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def peek(self, key, default=None):
+        """Get an entry or `default`, without locking or marking it as recently used.
+
+        Cheaper than :meth:`get` for lookups that don't mind missing an entry inserted
+        by another thread at the same time.
+        """
+        entry = self._data.get(key)
+        if entry is None or self._expired(entry[2]):
+            return default
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+            expires = None if self.ttl is None else time.monotonic() + self.ttl
+            self._data[key] = (value, size, expires)
+            self._bytes += size
+            self._evict()
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._bytes -= self._data.pop(key)[1]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        # iterate over a copy, so the cache can be changed while iterating
+        with self._lock:
+            return iter(
+                [
+                    k
+                    for k, (_, _, expires) in self._data.items()
+                    if not self._expired(expires)
+                ]
+            )
+
+    def __len__(self):
+        return len(self._data)
+
+    def update(self, *args, **kwargs):
+        """Insert many entries at once, atomically for other threads."""
+        items = dict(*args, **kwargs)
+        with self._lock:
+            expires = None if self.ttl is None else time.monotonic() + self.ttl
+            for key, value in items.items():
+                size = self.sizeof(value) if self.max_bytes is not None else 0
+                if key in self._data:
+                    self._bytes -= self._data.pop(key)[1]
+                self._data[key] = (value, size, expires)
+                self._bytes += size
+            # evicting once at the end leaves the same entries as after each insert
+            self._evict()
+
+    def setdefault(self, key, default=None):
+        """Get an entry, inserting `default` first if it doesn't exist."""
+        with self._lock:
+            return super().setdefault(key, default)
+
+    def copy(self):
+        """Get a dict of all entries, without changing their recently used order."""
+        with self._lock:
+            return {
+                k: value
+                for k, (value, _, expires) in self._data.items()
+                if not self._expired(expires)
+            }
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def get_or_load(self, key, load):
+        """Get an entry, loading it on a cache miss.
+
+        If several threads ask for the same missing key at the same time, only one of
+        them calls `load`. The others wait for its result.
+
+        Parameters
+        ----------
+        key
+            The key.
+        load : callable
+            Called with `key` on a cache miss. Should return the value or `None` if it
+            doesn't exist. `None` is not cached.
+
+        Returns
+        -------
+        The value or `None`.
+        """
+
+        def _load_many(keys):
+            value = load(keys[0])
+            return {} if value is None else {keys[0]: value}
+
+        return self.get_or_load_many([key], _load_many)[key]
+
+    def get_or_load_many(self, keys, load_many):
+        """Get many entries, loading all missing ones with a single call.
+
+        Keys that another thread is already loading are not loaded again, instead this
+        waits for the other thread.
+
+        Parameters
+        ----------
+        keys : iterable
+            The keys.
+        load_many : callable
+            Called with a list of the missing keys. Should return a dict with the values
+            it found.
+
+        Returns
+        -------
+        dict
+            Values for all `keys`. `None` for the ones that don't exist.
+        """
+        result = dict()
+        own = dict()
+        waiting = dict()
+        with self._lock:
+            for key in keys:
+                if key in result or key in own or key in waiting:
+                    continue
+                try:
+                    result[key] = self[key]
+                    continue
+                except KeyError:
+                    pass
+                if key in self._loading:
+                    waiting[key] = self._loading[key]
+                else:
+                    own[key] = self._loading[key] = _Flight()
+
+        if own:
+            loaded = dict()
+            error = None
+            try:
+                loaded = load_many(list(own))
+            except BaseException as err:
+                error = err
+                raise
+            finally:
+                with self._lock:
+                    for key, flight in own.items():
+                        value = loaded.get(key)
+                        if value is not None:
+                            self[key] = value
+                        flight.value = value
+                        flight.error = error
+                        del self._loading[key]
+                        flight.event.set()
+            for key in own:
+                result[key] = loaded.get(key)
+
+        for key, flight in waiting.items():
+            result[key] = flight.wait()
+
+        return result
+
+    def __repr__(self):
+        return (
+            f"<LRUCache: {len(self)} entries, max_entries={self.max_entries}, "
+            f"max_bytes={self.max_bytes}, ttl={self.ttl}>"
+        )
@@ -0,0 +1,720 @@
+"""Compact array representation of the dataset forest."""
+
+import numpy as np
+import peewee
+
+from . import orm, snapshot
+
+# Logging
+# =======
+
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+
+# Parent index of root datasets
+NO_PARENT = -1
+# Parent index of datasets whose base dataset is not in the forest
+UNKNOWN_PARENT = -2
+
+
+def _stream(query, chunk_size):
+    """Iterate over the rows of a query in chunks, without buffering all of them.
+
+    On MySQL this uses a server-side cursor. Other databases (like SQLite) stream
+    results with their default cursor. The rows are not converted by the fields.
+    """
+    db = query.model._meta.database
+    db = getattr(db, "obj", db)  # unwrap a database proxy
+    sql, params = query.sql()
+
+    cursor = None
+    if isinstance(db, peewee.MySQLDatabase):
+        try:
+            import pymysql.cursors
+
+            cursor = db.connection().cursor(pymysql.cursors.SSCursor)
+            cursor.execute(sql, params)
+        except ImportError:
+            _logger.debug("pymysql not available, streaming with default cursor.")
+    if cursor is None:
+        cursor = db.execute_sql(sql, params)
+
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def _rows_to_arrays(rows):
+    """Convert (id, base, root, time, state, type) rows to per-dataset arrays."""
+    if rows:
+        ids, base_ids, root, time, state_ids, type_ids = zip(*rows)
+    else:
+        ids, base_ids, root, time, state_ids, type_ids = [()] * 6
+    return (
+        np.asarray(ids, dtype="S32"),
+        np.asarray([b or "" for b in base_ids], dtype="S32"),
+        np.asarray(root, dtype=bool),
+        np.asarray(time, dtype="datetime64[us]"),
+        np.asarray(state_ids, dtype="S32"),
+        np.asarray([-1 if t is None else t for t in type_ids], dtype=np.int32),
+    )
+
+
+def _fixed_ids(ids):
+    """Convert dataset IDs to the fixed-width bytes the forest stores them as.
+
+    Unicode IDs are converted through their character codes, which is a lot faster
+    than `astype`.
+
+    Parameters
+    ----------
+    ids : np.ndarray
+        1D array of IDs.
+
+    Returns
+    -------
+    ids : np.ndarray of S32
+        The IDs, zero-padded.
+    valid : np.ndarray of bool
+        False for IDs that can't be in a forest: longer than 32 characters or not
+        ASCII. Those are garbage in `ids`.
+    """
+    if ids.dtype.kind not in "SU":
+        ids = ids.astype("U")
+    n, width = len(ids), ids.dtype.itemsize
+    if ids.dtype.kind == "U":
+        codes = np.ascontiguousarray(ids).view(np.uint32).reshape(n, width // 4)
+        valid = (codes < 128).all(axis=1)
+    else:
+        codes = np.ascontiguousarray(ids).view(np.uint8).reshape(n, width)
+        valid = np.ones(n, dtype=bool)
+    if codes.shape[1] > 32:
+        valid &= ~codes[:, 32:].any(axis=1)
+
+    fixed = np.zeros((n, 32), dtype=np.uint8)
+    fixed[:, : codes.shape[1]] = codes[:, :32]
+    return fixed.view("S32").reshape(n), valid
+
+
+def _raw(ids):
+    """View fixed-width strings as raw bytes."""
+    ids = np.ascontiguousarray(ids)
+    return ids.view(np.dtype((np.void, ids.dtype.itemsize)))
+
+
+def _hash_ids(ids):
+    """Hash fixed-width string IDs to uint64, using their raw bytes."""
+    ids = np.ascontiguousarray(ids)
+    if ids.dtype.itemsize % 8:
+        # pad to whole words
+        ids = ids.astype(f"{ids.dtype.kind}{-(-ids.dtype.itemsize // 8) * 8}")
+    words = ids.view(np.uint64).reshape(len(ids), -1)
+    keys = np.full(len(ids), 0xCBF29CE484222325, dtype=np.uint64)
+    for k in range(words.shape[1]):
+        keys ^= words[:, k]
+        keys *= np.uint64(0x100000001B3)
+        keys ^= keys >> np.uint64(29)
+    return keys
+
+
+class DatasetForest:
+    """All datasets as a set of numpy arrays.
+
+    Datasets are identified by their position in the arrays. IDs are stored as
+    fixed-width bytes and looked up through a sorted index, parents are stored as
+    positions and states and types as integer codes. This takes a fraction of the
+    memory of the equivalent :class:`chimedb.dataset.get.Dataset` objects.
+
+    Parameters
+    ----------
+    ids : np.ndarray of S32
+        Dataset IDs.
+    parent : np.ndarray of int32
+        Position of the base dataset. `NO_PARENT` for root datasets and
+        `UNKNOWN_PARENT` if the base dataset is not in the forest.
+    root : np.ndarray of bool
+        Root flag of each dataset.
+    time : np.ndarray of datetime64[us]
+        Time of each dataset.
+    state : np.ndarray of int32
+        Index into `state_ids` for each dataset.
+    state_ids : np.ndarray of S32
+        IDs of the states of the datasets.
+    state_type : np.ndarray of int32
+        Type ID of each state in `state_ids`. -1 if unknown.
+    types : dict of int -> str
+        Names of the state types by ID.
+    unresolved : dict of int -> str, optional
+        Base dataset IDs of the datasets with an `UNKNOWN_PARENT`.
+    """
+
+    def __init__(
+        self,
+        ids,
+        parent,
+        root,
+        time,
+        state,
+        state_ids,
+        state_type,
+        types,
+        unresolved=None,
+    ):
+        self.ids = ids
+        self.parent = parent
+        self.root = root
+        self.time = time
+        self.state = state
+        self.state_ids = state_ids
+        self.state_type = state_type
+        self.types = types
+        self.unresolved = unresolved or dict()
+
+        self._order = None
+        self._hash_index = None
+        self._state_id_strings = None
+        self._type_id = None
+        self._tables = dict()
+        self._children = None
+
+    # Construction
+    # ============
+
+    @classmethod
+    def build(cls, ids, base_ids, root, time, ds_state_ids, ds_type_ids, types):
+        """Create a forest from per-dataset arrays.
+
+        Parameters
+        ----------
+        ids : array_like of str or bytes
+            Dataset IDs.
+        base_ids : array_like of str or bytes
+            Base dataset ID of each dataset. Empty for root datasets.
+        root : array_like of bool
+            Root flag of each dataset.
+        time : array_like of datetime
+            Time of each dataset.
+        ds_state_ids : array_like of str or bytes
+            State ID of each dataset.
+        ds_type_ids : array_like of int
+            State type ID of each dataset. -1 if unknown.
+        types : dict of int -> str
+            Names of the state types by ID.
+
+        Returns
+        -------
+        DatasetForest
+        """
+        ids = np.asarray(ids, dtype="S32")
+        base_ids = np.asarray(base_ids, dtype="S32")
+        root = np.asarray(root, dtype=bool)
+        time = np.asarray(time, dtype="datetime64[us]")
+        ds_type_ids = np.asarray(ds_type_ids, dtype=np.int32)
+
+        state_ids, state = np.unique(
+            np.asarray(ds_state_ids, dtype="S32"), return_inverse=True
+        )
+        state_type = np.full(len(state_ids), -1, dtype=np.int32)
+        state_type[state] = ds_type_ids
+
+        forest = cls(
+            ids=ids,
+            parent=np.full(len(ids), NO_PARENT, dtype=np.int32),
+            root=root,
+            time=time,
+            state=state.astype(np.int32),
+            state_ids=state_ids,
+            state_type=state_type,
+            types=dict(types),
+        )
+
+        has_base = ~root & (base_ids != b"")
+        parent = forest.positions(base_ids[has_base])
+        unknown = parent < 0
+        parent[unknown] = UNKNOWN_PARENT
+        forest.parent[has_base] = parent
+
+        positions = np.flatnonzero(has_base)[unknown]
+        forest.unresolved = {
+            int(i): base.decode() for i, base in zip(positions, base_ids[positions])
+        }
+        return forest
+
+    @classmethod
+    def from_query(cls, since=None, chunk_size=None):
+        """Fetch the forest from the database.
+
+        Parameters
+        ----------
+        since : datetime, optional
+            Only fetch datasets with a time not older than this.
+        chunk_size : int, optional
+            If given, stream the rows with a server-side cursor and convert them to
+            arrays in chunks of this size, instead of buffering the whole result set.
+
+        Returns
+        -------
+        DatasetForest
+        """
+        query = (
+            orm.Dataset.select(
+                orm.Dataset.id,
+                orm.Dataset.base_dset,
+                orm.Dataset.root,
+                orm.Dataset.time,
+                orm.Dataset.state,
+                orm.DatasetState.type,
+            )
+            .join(orm.DatasetState)
+            .tuples()
+        )
+        if since is not None:
+            query = query.where(orm.Dataset.time >= since)
+
+        if chunk_size is None:
+            chunks = [list(query)]
+        else:
+            chunks = _stream(query, chunk_size)
+        columns = [[] for _ in range(6)]
+        for rows in chunks:
+            for column, array in zip(columns, _rows_to_arrays(rows)):
+                column.append(array)
+        if not columns[0]:
+            for column, array in zip(columns, _rows_to_arrays([])):
+                column.append(array)
+
+        types = {t.id: t.name for t in orm.DatasetStateType.select()}
+        return cls.build(*[np.concatenate(c) for c in columns], types)
+
+    @classmethod
+    def from_datasets(cls, datasets, type_ids, types):
+        """Create a forest from dataset objects.
+
+        Parameters
+        ----------
+        datasets : list of Dataset
+            The datasets.
+        type_ids : list of int
+            State type ID of each dataset. -1 if unknown.
+        types : dict of int -> str
+            Names of the state types by ID.
+
+        Returns
+        -------
+        DatasetForest
+        """
+        return cls.build(
+            [d.id for d in datasets],
+            [d.base_dset_id or "" for d in datasets],
+            [bool(d.root) for d in datasets],
+            [d.time for d in datasets],
+            [d.state_id for d in datasets],
+            type_ids,
+            types,
+        )
+
+    def merge(self, other):
+        """Create a forest with the datasets of this and another forest.
+
+        Datasets in `other` replace those with the same ID in this forest.
+
+        Parameters
+        ----------
+        other : DatasetForest
+            Forest with the datasets to add.
+
+        Returns
+        -------
+        DatasetForest
+        """
+        keep = ~np.isin(self.ids, other.ids)
+        columns = [
+            np.concatenate([a, b])
+            for a, b in zip(self._columns(keep), other._columns())
+        ]
+        return DatasetForest.build(*columns, {**self.types, **other.types})
+
+    def extend(self, other):
+        """Create a forest with the new datasets of another forest added.
+
+        Unlike :meth:`merge`, datasets of `other` that are in this forest already are
+        skipped and the closest ancestor tables computed so far are extended instead of
+        being dropped.
+
+        Parameters
+        ----------
+        other : DatasetForest
+            Forest with the datasets to add.
+
+        Returns
+        -------
+        DatasetForest
+            This forest if `other` has no new datasets.
+        """
+        new = self.positions(other.ids) < 0
+        if not new.any():
+            return self
+        columns = [
+            np.concatenate([a, b]) for a, b in zip(self._columns(), other._columns(new))
+        ]
+        forest = DatasetForest.build(*columns, {**self.types, **other.types})
+
+        # The datasets of this forest keep their positions. Their closest ancestors
+        # only change if a new dataset is one of their unknown base datasets.
+        n = len(self)
+        if np.array_equal(forest.parent[:n], self.parent) and np.array_equal(
+            forest.type_id[:n], self.type_id
+        ):
+            for type_id, table in self._tables.items():
+                forest._tables[type_id] = forest._closest_ancestors(type_id, table)
+        return forest
+
+    def _columns(self, select=slice(None)):
+        """Get the arrays to :meth:`build` the selected datasets again."""
+        return (
+            self.ids[select],
+            self.base_ids()[select],
+            self.root[select],
+            self.time[select],
+            self.state_ids[self.state][select],
+            self.type_id[select],
+        )
+
+    # Snapshots
+    # =========
+
+    def save(self, path):
+        """Write the forest to a snapshot file.
+
+        Parameters
+        ----------
+        path : str
+            The snapshot file. See :mod:`chimedb.dataset.snapshot`.
+        """
+        unresolved = sorted(self.unresolved.items())
+        arrays = {
+            "ids": self.ids,
+            "parent": self.parent,
+            "root": self.root,
+            "time": self.time,
+            "state": self.state,
+            "state_ids": self.state_ids,
+            "state_type": self.state_type,
+            "unresolved": np.array([i for i, _ in unresolved], dtype=np.int64),
+            "unresolved_ids": np.array([b for _, b in unresolved], dtype="S32"),
+        }
+        snapshot.write(path, arrays, watermark=self.watermark, types=self.types)
+
+    @classmethod
+    def load(cls, path):
+        """Load a forest from a snapshot file.
+
+        The arrays are memory-mapped read-only, so processes loading the same snapshot
+        share the memory.
+
+        Parameters
+        ----------
+        path : str
+            The snapshot file.
+
+        Returns
+        -------
+        DatasetForest
+
+        Raises
+        ------
+        chimedb.dataset.snapshot.SnapshotError
+            If the file is missing, corrupt or has an incompatible schema version.
+        """
+        snap = snapshot.read(path)
+        return cls(
+            ids=snap["ids"],
+            parent=snap["parent"],
+            root=snap["root"],
+            time=snap["time"],
+            state=snap["state"],
+            state_ids=snap["state_ids"],
+            state_type=snap["state_type"],
+            types=snap.types,
+            unresolved={
+                i: base_id.decode()
+                for i, base_id in zip(
+                    snap["unresolved"].tolist(), snap["unresolved_ids"].tolist()
+                )
+            },
+        )
+
+    # Access
+    # ======
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return f"<DatasetForest: {len(self)} datasets, {len(self.state_ids)} states>"
+
+    @property
+    def watermark(self):
+        """Time of the newest dataset or `None`."""
+        times = self.time[~np.isnat(self.time)]
+        return times.max().item() if len(times) else None
+
+    @property
+    def type_id(self):
+        """State type ID of each dataset (-1 if unknown)."""
+        if self._type_id is None:
+            self._type_id = self.state_type[self.state]
+        return self._type_id
+
+    def base_ids(self):
+        """Get the base dataset ID of each dataset (empty if it has none)."""
+        base = np.zeros(len(self), dtype="S32")
+        has_parent = self.parent >= 0
+        base[has_parent] = self.ids[self.parent[has_parent]]
+        for i, base_id in self.unresolved.items():
+            base[i] = base_id
+        return base
+
+    def positions(self, ds_ids):
+        """Look up the positions of many datasets.
+
+        IDs are looked up by a hash of their fixed-width bytes in a sorted index, built on
+        first use.
+
+        Parameters
+        ----------
+        ds_ids : array_like of str or bytes
+            Dataset IDs.
+
+        Returns
+        -------
+        np.ndarray of int
+            Position of each dataset, -1 for IDs not in the forest.
+        """
+        ds_ids = np.asarray(ds_ids)
+        if len(self) == 0 or ds_ids.size == 0:
+            return np.full(ds_ids.shape, -1, dtype=np.int64)
+        query, valid = _fixed_ids(ds_ids.ravel())
+
+        ids, keys, order, collisions = self._hash_index_for_ids()
+        hashes = _hash_ids(query)
+        i = np.searchsorted(keys, hashes)
+        pos = order[np.minimum(i, len(self) - 1)]
+        # compare the raw bytes to rule out hash collisions, that's much faster than
+        # comparing strings
+        pos[(ids[pos] != _raw(query)) | ~valid] = -1
+
+        if collisions is not None:
+            # different IDs with the same hash: binary search the IDs themselves
+            slow = np.isin(hashes, collisions) & valid
+            pos[slow] = self._search_ids(query[slow])
+
+        return pos.reshape(ds_ids.shape)
+
+    def _hash_index_for_ids(self):
+        """Get the IDs as raw bytes, their sorted hashes, order and collisions."""
+        if self._hash_index is None:
+            keys = _hash_ids(self.ids)
+            order = np.argsort(keys)
+            keys = keys[order]
+            duplicate = keys[1:] == keys[:-1]
+            collisions = np.unique(keys[1:][duplicate]) if duplicate.any() else None
+            self._hash_index = (_raw(self.ids), keys, order, collisions)
+        return self._hash_index
+
+    def _search_ids(self, ds_ids):
+        """Binary search for S32 IDs in the sorted IDs."""
+        if self._order is None:
+            self._order = np.argsort(self.ids, kind="stable")
+        i = np.searchsorted(self.ids, ds_ids, sorter=self._order)
+        pos = self._order[np.minimum(i, len(self) - 1)]
+        return np.where(self.ids[pos] == ds_ids, pos, -1)
+
+    def position(self, ds_id):
+        """Get the position of a dataset or -1 if it's not in the forest."""
+        return int(self.positions([ds_id])[0])
+
+    def id(self, i):
+        """Get the ID of the dataset at a position."""
+        return self.ids[i].decode()
+
+    def state_id_strings(self):
+        """Get the state IDs as a unicode array (cached)."""
+        if self._state_id_strings is None:
+            self._state_id_strings = self.state_ids.astype("U32")
+        return self._state_id_strings
+
+    def state_id(self, i):
+        """Get the state ID of the dataset at a position."""
+        return self.state_ids[self.state[i]].decode()
+
+    def base_id(self, i):
+        """Get the ID of the base dataset of the dataset at a position or `None`."""
+        parent = self.parent[i]
+        if parent >= 0:
+            return self.id(parent)
+        return self.unresolved.get(int(i))
+
+    # Algorithms
+    # ==========
+
+    def _jump(self, pointers):
+        """Follow pointers until they reach a fixed point (pointer jumping)."""
+        while True:
+            jumped = pointers[pointers]
+            if np.array_equal(jumped, pointers):
+                return pointers
+            pointers = jumped
+
+    def closest_ancestor_table(self, type_id):
+        """Get the closest ancestor of a type for every dataset.
+
+        The table is computed on first use with vectorised pointer jumping, which takes
+        O(N log(depth)) for N datasets, and kept for later calls.
+
+        Parameters
+        ----------
+        type_id : int
+            ID of the state type.
+
+        Returns
+        -------
+        np.ndarray of int32
+            Position of the closest ancestor of each dataset (including itself). -1 if
+            there is none and -2 if it can't be determined, because a base dataset or
+            type is unknown.
+        """
+        try:
+            return self._tables[type_id]
+        except KeyError:
+            pass
+
+        closest = self._closest_ancestors(type_id)
+        self._tables[type_id] = closest
+        return closest
+
+    def _closest_ancestors(self, type_id, known=None):
+        """Compute a closest ancestor table, given the `known` table of the first datasets."""
+        n = len(self)
+        none, unknown = n, n + 1
+
+        # Point each dataset to itself if it has the type, otherwise to its parent and
+        # make the sentinels point to themselves...
+        parent = np.where(self.parent == NO_PARENT, none, self.parent)
+        parent[parent == UNKNOWN_PARENT] = unknown
+        closest = np.empty(n + 2, dtype=np.int32)
+        closest[:n] = np.where(self.type_id == type_id, np.arange(n), parent)
+        closest[:n][self.type_id < 0] = unknown
+        closest[n:] = [none, unknown]
+        if known is not None:
+            # these already point to fixed points
+            closest[: len(known)] = known
+            closest[: len(known)][known == -1] = none
+            closest[: len(known)][known == -2] = unknown
+
+        # ...then jump until every pointer ends on one of these fixed points.
+        closest = self._jump(closest)[:n]
+        closest[closest == none] = -1
+        closest[closest == unknown] = -2
+        return closest
+
+    def roots(self):
+        """Get the position of the root of every dataset's tree.
+
+        Returns
+        -------
+        np.ndarray of int32
+            Position of the root, -2 if a base dataset is missing from the forest.
+        """
+        n = len(self)
+        unknown = n
+        pointers = np.empty(n + 1, dtype=np.int32)
+        pointers[:n] = np.where(self.parent == NO_PARENT, np.arange(n), self.parent)
+        pointers[:n][self.parent == UNKNOWN_PARENT] = unknown
+        pointers[n] = unknown
+
+        roots = self._jump(pointers)[:n]
+        roots[roots == unknown] = -2
+        return roots
+
+    def root_of(self, i):
+        """Find the root of the tree containing the dataset at a position.
+
+        This walks up the parents, so it takes O(depth).
+
+        Returns
+        -------
+        int
+            Position of the root. If a base dataset is missing from the forest, this is
+            the topmost dataset that is in the forest.
+        """
+        parent = self.parent
+        while parent[i] >= 0:
+            i = parent[i]
+        return int(i)
+
+    def _children_index(self):
+        """Get the children of all datasets in compressed sparse row format.
+
+        Returns
+        -------
+        offsets : np.ndarray of int64
+            The children of the dataset at position `i` are
+            `children[offsets[i]:offsets[i + 1]]`.
+        children : np.ndarray of int32
+            Positions of the children, grouped by parent.
+        """
+        if self._children is None:
+            n = len(self)
+            has_parent = np.flatnonzero(self.parent >= 0)
+            parent = self.parent[has_parent]
+            children = has_parent[np.argsort(parent, kind="stable")].astype(np.int32)
+            offsets = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(parent, minlength=n), out=offsets[1:])
+            self._children = (offsets, children)
+        return self._children
+
+    def children(self, i):
+        """Get the positions of the children of the dataset at a position."""
+        offsets, children = self._children_index()
+        return children[offsets[i] : offsets[i + 1]]
+
+    def levels(self, i):
+        """Iterate breadth-first over the descendants of the dataset at a position.
+
+        The CSR children index is built on first use, after that each level is
+        gathered with a few vectorised operations.
+
+        Parameters
+        ----------
+        i : int
+            Position of the dataset.
+
+        Yields
+        ------
+        np.ndarray of int32
+            The positions of the datasets at depth 0 (the dataset itself), 1 (its
+            children), 2 and so on.
+        """
+        offsets, children = self._children_index()
+        level = np.array([i], dtype=np.int32)
+        while len(level):
+            yield level
+            start, count = offsets[level], offsets[level + 1] - offsets[level]
+            total = int(count.sum())
+            # index of each child in `children`: start of its parent's range plus its
+            # rank within that range
+            ranges = np.repeat(start - np.cumsum(count) + count, count)
+            level = children[ranges + np.arange(total)]
+
+    def tree_size(self, i):
+        """Count the datasets in the tree containing the dataset at a position."""
+        return sum(len(level) for level in self.levels(self.root_of(i)))
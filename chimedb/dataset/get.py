@@ -3,10 +3,21 @@
 # Imports
 # =======
 
+import asyncio
 from collections.abc import Mapping
+import datetime
+import json
+import os
+import re
+import sys
+import threading
 import warnings
 
-from . import orm
+import peewee
+
+from . import orm, snapshot
+from .cache import LRUCache, approx_sizeof
+from .forest import DatasetForest
 from chimedb.core.exceptions import NotFoundError, ValidationError
 
 # Logging
@@ -19,10 +30,107 @@ _logger.addHandler(logging.NullHandler())
 
 
 # local cache for states etc so they don't get transferred from the database repeatedly
-_state_cache = dict()
-_dataset_cache = dict()
-_type_cache = dict()  # by name
-_type_cache_by_id = dict()
+def _state_size(state):
+    """Approximate memory used by the .data of a cached state."""
+    return approx_sizeof(state.__data__.get("data"))
+
+
+_state_cache = LRUCache(sizeof=_state_size)
+_dataset_cache = LRUCache()
+_type_cache = LRUCache()  # by name
+_type_cache_by_id = LRUCache()
+# decoded payloads shared by several states, by content hash
+_payload_cache = LRUCache()
+# closest ancestor of a type, by (dataset ID, type ID): the ancestor's ID or None
+_closest_cache = LRUCache()
+
+# serialises calls to index()
+_index_lock = threading.Lock()
+
+# time of the newest dataset fetched by index()
+_watermark = None
+
+# refresh() fetches rows this much older than the watermark again, in case they were
+# inserted into the database late
+_REFRESH_OVERLAP = datetime.timedelta(minutes=1)
+
+
+def configure_cache(
+    max_datasets=None,
+    max_states=None,
+    max_state_bytes=None,
+    max_types=None,
+    max_payloads=None,
+    max_ancestors=None,
+    ttl=None,
+):
+    """Set limits for the local caches.
+
+    By default the caches are unbounded. The defaults can be changed with the
+    environment variables `CHIMEDB_DATASET_CACHE_MAX_DATASETS`,
+    `CHIMEDB_DATASET_CACHE_MAX_STATES`, `CHIMEDB_DATASET_CACHE_MAX_STATE_BYTES`,
+    `CHIMEDB_DATASET_CACHE_MAX_TYPES`, `CHIMEDB_DATASET_CACHE_MAX_PAYLOADS`,
+    `CHIMEDB_DATASET_CACHE_MAX_ANCESTORS` and `CHIMEDB_DATASET_CACHE_TTL`.
+
+    When a cache is full, the least recently used entries are evicted. Note that
+    datasets still referenced as the base dataset of a cached dataset stay in memory.
+
+    Parameters
+    ----------
+    max_datasets : int, optional
+        Maximum number of cached datasets.
+    max_states : int, optional
+        Maximum number of cached states.
+    max_state_bytes : int, optional
+        Maximum approximate size of all cached state .data in bytes.
+    max_types : int, optional
+        Maximum number of cached state types.
+    max_payloads : int, optional
+        Maximum number of cached deduplicated payloads (see
+        :func:`chimedb.dataset.insert.configure_dedup`).
+    max_ancestors : int, optional
+        Maximum number of remembered results of
+        :meth:`Dataset.closest_ancestor_of_type`.
+    ttl : float, optional
+        Time in seconds after which cache entries expire.
+    """
+    _dataset_cache.configure(max_entries=max_datasets, ttl=ttl)
+    _state_cache.configure(max_entries=max_states, max_bytes=max_state_bytes, ttl=ttl)
+    _type_cache.configure(max_entries=max_types, ttl=ttl)
+    _type_cache_by_id.configure(max_entries=max_types, ttl=ttl)
+    _payload_cache.configure(max_entries=max_payloads, ttl=ttl)
+    _closest_cache.configure(max_entries=max_ancestors, ttl=ttl)
+
+
+def _cache_config_from_env():
+    """Read the cache limits from the environment."""
+
+    def _get(name, type_):
+        value = os.environ.get("CHIMEDB_DATASET_CACHE_" + name)
+        return None if value in (None, "") else type_(value)
+
+    return dict(
+        max_datasets=_get("MAX_DATASETS", int),
+        max_states=_get("MAX_STATES", int),
+        max_state_bytes=_get("MAX_STATE_BYTES", int),
+        max_types=_get("MAX_TYPES", int),
+        max_payloads=_get("MAX_PAYLOADS", int),
+        max_ancestors=_get("MAX_ANCESTORS", int),
+        ttl=_get("TTL", float),
+    )
+
+
+configure_cache(**_cache_config_from_env())
+
+# maximum number of IDs sent in a single `WHERE id IN (...)` query
+_IN_CHUNK_SIZE = 1000
+
+
+def _chunks(ids, size=None):
+    """Split a list of IDs into chunks of at most `size` entries."""
+    size = size or _IN_CHUNK_SIZE
+    for i in range(0, len(ids), size):
+        yield ids[i : i + size]
 
 
 class DatasetStateType(orm.DatasetStateType):
@@ -56,19 +164,20 @@ class DatasetStateType(orm.DatasetStateType):
             If the type with the requested name doesn't exist in the database. Use
             chimedb.dataset.insert to create rows.
         """
-        try:
-            # look in cache first
-            return _type_cache[name]
-        except KeyError:
-            # ask database
-            new_type = orm.DatasetStateType.get(orm.DatasetStateType.name == name)
-            if new_type is None:
-                return None
 
-            # fill cache
-            _type_cache[name] = new_type
+        def _load(name):
+            # ask database (if concurrent inserts created duplicates, the lowest ID wins)
+            new_type = (
+                orm.DatasetStateType.select()
+                .where(orm.DatasetStateType.name == name)
+                .order_by(orm.DatasetStateType.id)
+                .get()
+            )
             _type_cache_by_id[new_type.id] = new_type
-            return _type_cache[name]
+            return new_type
+
+        # look in cache first
+        return _type_cache.get_or_load(name, _load)
 
     def __repr__(self):
         return f"<get.DatasetStateType: {self.name}>"
@@ -80,8 +189,16 @@ class DatasetState(orm.DatasetState):
 
     This wraps the model in chimedb.database.orm and adds a local cache and additional
     functionality.
+
+    States can be loaded without their .data (see `from_id`). The data of such a
+    deferred state is fetched from the database on first access of .data, together
+    with the data of up to `_DEFERRED_BATCH_SIZE` other deferred states that were
+    loaded in the same call.
     """
 
+    # IDs of the deferred states loaded together with this one
+    _deferred_group = None
+
     @classmethod
     def from_id(cls, state_id, load_data=True):
         """Create a new DatasetState object.
@@ -94,28 +211,141 @@ class DatasetState(orm.DatasetState):
         state_id
             State ID.
         load_data : bool
-            .data is only loaded and cached if this is True.
+            If False, only ID, type and time are loaded and .data is loaded on first
+            access. If True and the cached state has no data yet, its data is loaded.
 
         Returns
         -------
         DatasetState or None
             The requested state. Or None if it wasn't found.
         """
-        if state_id not in _state_cache.keys():
+
+        def _load(state_id):
+            _logger.debug(f"Loading state {state_id} from database...")
+            query = DatasetState.select(*_state_fields(load_data))
             try:
-                _logger.debug(f"Loading state {state_id} from database...")
-                if load_data:
-                    _state_cache[state_id] = DatasetState.get(
-                        DatasetState.id == state_id
-                    )
-                else:
-                    _state_cache[state_id] = DatasetState.select(
-                        DatasetState.type, DatasetState.time
-                    ).get()
-            except orm.DatasetState.DoesNotExist:
+                return query.where(DatasetState.id == state_id).get()
+            except DatasetState.DoesNotExist:
                 _logger.warning(f"Could not find state {state_id}.")
                 return None
-        return _state_cache[state_id]
+
+        state = _state_cache.get_or_load(state_id, _load)
+        if load_data and state is not None and not state.data_loaded:
+            _load_data([state])
+        return state
+
+    @classmethod
+    def from_ids(cls, state_ids, load_data=True):
+        """Get many DatasetState objects at once.
+
+        All states missing from the cache are fetched from the database with as few
+        queries as possible (one per `_IN_CHUNK_SIZE` IDs).
+        This does not insert new rows into the database.
+
+        Parameters
+        ----------
+        state_ids : iterable of str
+            State IDs.
+        load_data : bool
+            .data is only loaded and cached if this is True.
+
+        Returns
+        -------
+        list of DatasetState or None
+            The requested states in the order of `state_ids`. Unknown IDs give `None`.
+        """
+        state_ids = list(state_ids)
+        fields = _state_fields(load_data)
+
+        def _load_many(missing):
+            _logger.debug(f"Loading {len(missing)} states from database...")
+            found = dict()
+            for chunk in _chunks(missing):
+                query = DatasetState.select(*fields).where(DatasetState.id.in_(chunk))
+                for s in query:
+                    found[s.id] = s
+
+            not_found = len(missing) - len(found)
+            if not_found:
+                _logger.warning(f"Could not find {not_found} of the requested states.")
+            if not load_data:
+                _group_deferred(found.values())
+            return found
+
+        found = _state_cache.get_or_load_many(state_ids, _load_many)
+        if load_data:
+            _load_data([s for s in found.values() if s and not s.data_loaded])
+        return [found[s] for s in state_ids]
+
+    @classmethod
+    def extract(cls, state_ids, path):
+        """Get one field of the data of many states.
+
+        On MySQL and SQLite only the requested part of the data is transferred, using
+        the JSON functions of the database. States whose data is compressed or
+        deduplicated, and databases without JSON functions, fall back to loading the
+        full data. States with cached data are not queried at all.
+
+        Parameters
+        ----------
+        state_ids : iterable of str
+            State IDs.
+        path : str
+            JSON path of the field, e.g. `$.freq` or `$.inputs[0].chan_id`. Only
+            member names (`.name` or `."name"`) and array indices (`[0]`) are
+            supported.
+
+        Returns
+        -------
+        dict of str -> object
+            The value of the field by state ID. `None` if the state or the field
+            doesn't exist.
+        """
+        keys = _parse_json_path(path)
+        state_ids = list(state_ids)
+
+        result = dict()
+        remote = []
+        for state_id in dict.fromkeys(state_ids):
+            state = _state_cache.get(state_id)
+            if state is not None and state.data_loaded:
+                result[state_id] = _follow_json_path(state.data, keys)
+            else:
+                remote.append(state_id)
+
+        fallback = remote
+        columns = _json_extract_columns(path)
+        if remote and columns is not None:
+            fallback = []
+            loads = orm.json_codec().loads
+            try:
+                for chunk in _chunks(remote):
+                    query = (
+                        DatasetState.select(DatasetState.id, *columns)
+                        .where(DatasetState.id.in_(chunk))
+                        .tuples()
+                    )
+                    for state_id, valid, value in query:
+                        if not valid:
+                            fallback.append(state_id)
+                        elif value is not None:
+                            result[state_id] = loads(value)
+            except (peewee.OperationalError, peewee.ProgrammingError) as err:
+                _logger.info(f"Extracting {path} in python: {err}")
+                fallback = [s for s in remote if s not in result]
+
+        if fallback:
+            _logger.debug(f"Loading data of {len(fallback)} states to extract {path}.")
+            for state in cls.from_ids(fallback):
+                if state is not None:
+                    result[state.id] = _follow_json_path(state.data, keys)
+
+        return {state_id: result.get(state_id) for state_id in state_ids}
+
+    @property
+    def data_loaded(self):
+        """True if .data is loaded (False if it will be loaded on first access)."""
+        return "data" in self.__data__
 
     def __repr__(self):
         type_ = self.state_type
@@ -127,14 +357,15 @@ class DatasetState(orm.DatasetState):
     @property
     def state_type(self):
         """Get state type."""
-        try:
-            return _type_cache_by_id[self.type_id]
-        except KeyError:
+
+        def _load(type_id):
             type_ = self.type
-            _type_cache_by_id[self.type_id] = type_
-            _type_cache[type_.name] = type_
+            if type_ is not None:
+                _type_cache[type_.name] = type_
             return type_
 
+        return _type_cache_by_id.get_or_load(self.type_id, _load)
+
     @staticmethod
     def exists(state_id):
         """
@@ -155,16 +386,173 @@ class DatasetState(orm.DatasetState):
         return orm.DatasetState.select().where(orm.DatasetState.id == state_id).exists()
 
 
+_JSON_PATH_TOKEN = re.compile(r'\.([A-Za-z_$][\w$]*)|\."((?:[^"\\]|\\.)*)"|\[(\d+)\]')
+
+
+def _parse_json_path(path):
+    """Parse a JSON path like `$.a."b c"[0]` into a list of keys and indices."""
+    if not isinstance(path, str) or not path.startswith("$"):
+        raise ValueError(f"JSON path must start with '$' (got {path!r}).")
+    keys = []
+    pos = 1
+    while pos < len(path):
+        match = _JSON_PATH_TOKEN.match(path, pos)
+        if match is None:
+            raise ValueError(f"Unsupported JSON path {path!r} at position {pos}.")
+        name, quoted, index = match.groups()
+        if index is not None:
+            keys.append(int(index))
+        elif quoted is not None:
+            keys.append(json.loads(f'"{quoted}"'))
+        else:
+            keys.append(name)
+        pos = match.end()
+    return keys
+
+
+def _follow_json_path(data, keys):
+    """Get the value at a parsed JSON path, `None` if it doesn't exist."""
+    for key in keys:
+        if isinstance(key, int):
+            if not isinstance(data, list) or key >= len(data):
+                return None
+        elif not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+def _json_extract_columns(path):
+    """Get SQL expressions telling if the data is JSON and extracting a path from it.
+
+    Returns `None` if the database has no JSON functions that we know of. The extracted
+    value is selected as JSON text.
+    """
+    db = DatasetState._meta.database
+    db = getattr(db, "obj", db)  # unwrap a database proxy
+    data = DatasetState.data
+
+    if isinstance(db, peewee.SqliteDatabase):
+        # blobs are compressed or references, they may look like JSONB to sqlite
+        valid = (peewee.fn.typeof(data) == "text") & (peewee.fn.json_valid(data) == 1)
+        value = peewee.fn.json_quote(peewee.fn.json_extract(data, path))
+    elif isinstance(db, peewee.MySQLDatabase):
+        # the column may be binary (see compress-states)
+        data = peewee.NodeList(
+            (peewee.SQL("CONVERT("), data, peewee.SQL("USING utf8mb4)"))
+        )
+        valid = peewee.fn.JSON_VALID(data) == 1
+        value = peewee.fn.JSON_EXTRACT(data, path)
+    else:
+        return None
+
+    return (
+        valid.alias("valid"),
+        peewee.Case(None, [(valid, value.coerce(False))], None).alias("value"),
+    )
+
+
+def _resolve_payload(hash):
+    """Get a deduplicated payload by hash.
+
+    Decoded payloads are interned, so all states referencing the same payload share one
+    dict. Don't modify the .data of states.
+    """
+
+    def _load(hash):
+        try:
+            return orm.DatasetStatePayload.get_by_id(hash).data
+        except orm.DatasetStatePayload.DoesNotExist:
+            _logger.warning(f"Could not find state payload {hash}.")
+            return None
+
+    return _payload_cache.get_or_load(hash, _load)
+
+
+orm.set_payload_resolver(_resolve_payload)
+
+
+# max. number of deferred states whose data is loaded together
+_DEFERRED_BATCH_SIZE = 100
+
+
+def _state_fields(load_data):
+    """Get the fields to select for a state with or without .data."""
+    if load_data:
+        return []
+    return [DatasetState.id, DatasetState.type, DatasetState.time]
+
+
+def _group_deferred(states):
+    """Group deferred states, so that their data is loaded together."""
+    states = list(states)
+    for i in range(0, len(states), _DEFERRED_BATCH_SIZE):
+        group = tuple(s.id for s in states[i : i + _DEFERRED_BATCH_SIZE])
+        for s in states[i : i + _DEFERRED_BATCH_SIZE]:
+            s._deferred_group = group
+
+
+def _load_data(states):
+    """Load the .data of deferred states from the database.
+
+    The cache entries are updated, so that their size is accounted for.
+    """
+    states = {s.id: s for s in states}
+    for chunk in _chunks(list(states)):
+        query = (
+            DatasetState.select(DatasetState.id, DatasetState.data)
+            .where(DatasetState.id.in_(chunk))
+            .tuples()
+        )
+        for state_id, data in query:
+            states[state_id].__data__["data"] = data
+
+    for state_id, state in states.items():
+        if not state.data_loaded:
+            _logger.warning(f"Could not find data of state {state_id}.")
+            state.__data__["data"] = None
+        state._deferred_group = None
+        with _state_cache.lock:
+            if _state_cache.get(state_id) is state:
+                _state_cache[state_id] = state
+
+
+class _DeferredDataAccessor(peewee.FieldAccessor):
+    """Accessor for DatasetState.data, loading deferred data on first access."""
+
+    def __get__(self, instance, instance_type=None):
+        if instance is not None and not instance.data_loaded and instance.id:
+            states = [instance]
+            for state_id in instance._deferred_group or ():
+                state = _state_cache.get(state_id)
+                if state is not None and state is not instance:
+                    if not state.data_loaded:
+                        states.append(state)
+            _load_data(states)
+        return super().__get__(instance, instance_type)
+
+
+DatasetState.data = _DeferredDataAccessor(
+    DatasetState, DatasetState._meta.fields["data"], "data"
+)
+
+
 class Dataset(orm.Dataset):
     """
     Model for dataset table.
 
     This wraps the model in chimedb.database.orm and adds a local cache and additional
     functionality.
+
+    The ID of the attached state is always available as `.state_id` without querying
+    the database. Prefer it over `.state.id`: accessing the `.state` foreign key selects
+    the whole state, including its data, bypassing the state cache.
     """
 
     # state type name
     _type = None
+    # state type ID
+    _type_id = None
 
     _base_dataset = None
 
@@ -189,19 +577,131 @@ class Dataset(orm.Dataset):
             raise ValidationError(
                 f"ds_id is of type {type(ds_id).__name__} (expected str)"
             )
-        if ds_id not in _dataset_cache:
+
+        def _load(ds_id):
+            forest = _forest
+            if forest is not None:
+                i = forest.position(ds_id)
+                if i >= 0:
+                    return _dataset_from_forest(forest, i)
             try:
-                _dataset_cache[ds_id] = Dataset.get(Dataset.id == ds_id)
-            except orm.Dataset.DoesNotExist:
+                return Dataset.get(Dataset.id == ds_id)
+            except Dataset.DoesNotExist:
                 _logger.warning(f"Could not find dataset {ds_id}.")
                 return None
-        return _dataset_cache[ds_id]
+
+        return _dataset_cache.get_or_load(ds_id, _load)
+
+    @classmethod
+    def from_ids(cls, ds_ids):
+        """Get many Dataset objects at once.
+
+        All datasets missing from the cache are fetched from the database with as few
+        queries as possible (one per `_IN_CHUNK_SIZE` IDs).
+        This does not insert new rows into the database.
+
+        Parameters
+        ----------
+        ds_ids : iterable of str
+            Dataset IDs.
+
+        Returns
+        -------
+        list of Dataset or None
+            The requested datasets in the order of `ds_ids`. Unknown IDs give `None`.
+        """
+        ds_ids = list(ds_ids)
+        for ds_id in ds_ids:
+            if not isinstance(ds_id, str):
+                raise ValidationError(
+                    f"ds_id is of type {type(ds_id).__name__} (expected str)"
+                )
+
+        def _load_many(missing):
+            found = dict()
+            forest = _forest
+            if forest is not None:
+                for ds_id, i in zip(missing, forest.positions(missing)):
+                    if i >= 0:
+                        found[ds_id] = _dataset_from_forest(forest, i)
+                missing = [d for d in missing if d not in found]
+                if not missing:
+                    return found
+
+            _logger.debug(f"Loading {len(missing)} datasets from database...")
+            for chunk in _chunks(missing):
+                for d in Dataset.select().where(Dataset.id.in_(chunk)):
+                    found[d.id] = d
+
+            not_found = sum(1 for d in missing if d not in found)
+            if not_found:
+                _logger.warning(
+                    f"Could not find {not_found} of the requested datasets."
+                )
+            return found
+
+        found = _dataset_cache.get_or_load_many(ds_ids, _load_many)
+        return [found[d] for d in ds_ids]
+
+    @classmethod
+    def lineage(cls, ds_id):
+        """Get a dataset and all of its ancestors.
+
+        All ancestors missing from the cache are fetched with a single query (see
+        :func:`prefetch_ancestors`).
+
+        Parameter
+        ----------
+        ds_id : str
+            Dataset ID.
+
+        Returns
+        -------
+        list of Dataset or None
+            The dataset followed by its base dataset, the base of that and so on up to
+            the root. `None` if the dataset wasn't found.
+        """
+        prefetch_ancestors([ds_id])
+
+        d = Dataset.from_id(ds_id)
+        if d is None:
+            return None
+
+        lineage = []
+        while d:
+            lineage.append(d)
+            d = d.base_dataset
+        return lineage
 
     @property
     def type(self):
-        """Get the type of the attached dataset state."""
+        """Get the type of the attached dataset state.
+
+        This doesn't load the data of the state.
+        """
+        if self._type is not None:
+            type_ = _type_cache.get(self._type)
+            if type_ is not None:
+                return type_
         return self.dataset_state.state_type
 
+    @property
+    def type_id(self):
+        """Get the ID of the type of the attached dataset state.
+
+        This is set when the dataset is indexed or prefetched, otherwise it is looked up
+        on first access without loading the data of the state. Comparing it is much
+        cheaper than comparing :attr:`type`.
+
+        Returns
+        -------
+        int or None
+            `None` if the state has no type.
+        """
+        if self._type_id is None:
+            self._type_id = getattr(self.type, "id", None)
+        return self._type_id
+
     @property
     def base_dataset(self):
         """Get the base dataset."""
@@ -211,14 +711,42 @@ class Dataset(orm.Dataset):
 
     @property
     def dataset_state(self):
-        """Get the dataset state."""
-        # get the raw ID of the state (foreign key)
-        orm_base_class = super()
-        state_id = orm_base_class.state_id
+        """Get the dataset state.
 
-        if state_id not in _state_cache:
-            _state_cache[state_id] = DatasetState.from_id(state_id)
-        return _state_cache[state_id]
+        The state comes from the cache. Its .data is only loaded on first access, so
+        use `.state_id` if the ID is all you need.
+        """
+        return DatasetState.from_id(self.state_id, load_data=False)
+
+    @property
+    def children(self):
+        """Get the datasets that have this one as their base dataset.
+
+        This uses the children index built by :func:`index`, so it only knows about
+        the datasets indexed so far.
+
+        Returns
+        -------
+        list of Dataset
+        """
+        return [d for d in Dataset.from_ids(_child_ids(self.id)) if d is not None]
+
+    def descendants(self):
+        """Iterate over all descendants of this dataset, breadth-first.
+
+        Like :attr:`children`, this uses the children index built by :func:`index`.
+
+        Yields
+        ------
+        Dataset
+            The children of this dataset, then their children and so on.
+        """
+        level = [self.id]
+        while level:
+            level = [c for ds_id in level for c in _child_ids(ds_id)]
+            for d in Dataset.from_ids(level):
+                if d is not None:
+                    yield d
 
     def __repr__(self):
         if self._type:
@@ -230,6 +758,11 @@ class Dataset(orm.Dataset):
         """
         Get the closest ancestorial dataset of the given type.
 
+        Unless the ancestor tables are used (see :func:`precompute_ancestors`), the
+        answer is remembered for every dataset visited while walking up, so that
+        lookups for siblings and descendants stop after a step or two. These are
+        forgotten when :func:`index` or :func:`refresh` add datasets.
+
         Parameters
         ----------
         type_ : str or :class:`chimedb.dataset.orm.DatasetStateType`
@@ -249,13 +782,54 @@ class Dataset(orm.Dataset):
             type_ = DatasetStateType.from_name(name=type_)
             if type_ is None:
                 raise NotFoundError(f"{type_} is not a known DatasetStateType")
-        d = self
 
+        forest = _ancestor_forest()
+        if forest is not None:
+            i = forest.position(self.id)
+            if i >= 0:
+                j = forest.closest_ancestor_table(type_.id)[i]
+                if j == -1:
+                    raise NotFoundError(
+                        "No ancestor of type {} found for Dataset {}".format(
+                            type_.name, self.__repr__()
+                        )
+                    )
+                if j >= 0:
+                    return self if j == i else Dataset.from_id(forest.id(j))
+
+        # Walk up until finding the type or a dataset whose answer is known already,
+        # then remember the answer for all datasets on the way. Looking for a known
+        # answer costs more than a step up, so it's only done for the first steps (to
+        # stop early for descendants of a dataset looked up before) and then every
+        # _MEMO_PROBE_INTERVAL steps.
+        type_id = type_.id
+        visited = []
+        closest = _NOT_CACHED
+        d = self
         while d:
-            if d.type == type_:
-                return d
+            steps = len(visited)
+            if steps < 2 or not steps % _MEMO_PROBE_INTERVAL:
+                closest = _closest_cache.peek((d.id, type_id), _NOT_CACHED)
+                if closest is not _NOT_CACHED:
+                    # remembered again below, so it stays recently used
+                    visited.append(d.id)
+                    break
+            visited.append(d.id)
+            if d.type_id == type_id:
+                closest = d.id
+                break
+            if d.root:
+                closest = None
+                break
             d = d.base_dataset
 
+        if closest is not _NOT_CACHED:
+            _closest_cache.update({(ds_id, type_id): closest for ds_id in visited})
+            if closest == self.id:
+                return self
+            if closest is not None:
+                return Dataset.from_id(closest)
+
         raise NotFoundError(
             "No ancestor of type {} found for Dataset {}".format(
                 type_.name, self.__repr__()
@@ -263,48 +837,725 @@ class Dataset(orm.Dataset):
         )
 
 
-def index():
-    """Pre-fetch and cache all Dataset(State(Type))s."""
+# marks a dataset whose closest ancestor of a type isn't known yet
+_NOT_CACHED = object()
+
+# Steps between looking for a remembered closest ancestor while walking up
+_MEMO_PROBE_INTERVAL = 16
+
+
+def _child_ids(ds_id):
+    """Get the IDs of the children of a dataset from the children index."""
+    forest = _forest
+    if forest is not None:
+        i = forest.position(ds_id)
+        if i >= 0:
+            return forest.ids[forest.children(i)].astype("U32").tolist()
+    return sorted(_children.get(ds_id, ()))
+
+
+def _dataset_type_id(d):
+    """Get the state type ID of a cached dataset without querying the database."""
+    if d._type_id is not None:
+        return d._type_id
+    if d._type is not None:
+        type_ = _type_cache.get(d._type)
+        if type_ is not None:
+            return type_.id
+    state = _state_cache.get(d.state_id)
+    if state is not None and state.type_id is not None:
+        return state.type_id
+    return -1
+
+
+def _dataset_from_forest(forest, i):
+    """Create the Dataset object for a position in a forest."""
+    d = Dataset(
+        id=forest.id(i),
+        root=bool(forest.root[i]),
+        state=forest.state_id(i),
+        time=forest.time[i].item(),
+        base_dset=forest.base_id(i),
+    )
+    type_id = int(forest.type_id[i])
+    d._type = forest.types.get(type_id)
+    if type_id >= 0:
+        d._type_id = type_id
+    return d
+
+
+def _forest_from_cache():
+    """Build a DatasetForest from the cached datasets."""
+    datasets = list(_dataset_cache.copy().values())
+    return DatasetForest.from_datasets(
+        datasets,
+        [_dataset_type_id(d) for d in datasets],
+        {t.id: t.name for t in _type_cache_by_id.copy().values()},
+    )
+
+
+def dataset_forest(create=True):
+    """Get all datasets as a :class:`chimedb.dataset.forest.DatasetForest`.
+
+    This is the forest fetched by `index(compact=True)` or else a forest built from
+    the cached datasets. If nothing is cached, `index(compact=True)` is called first.
+
+    Parameters
+    ----------
+    create : bool
+        If False, only return a forest that exists already, i.e. after
+        `index(compact=True)` or :func:`precompute_ancestors`.
+
+    Returns
+    -------
+    DatasetForest or None
+        `None` if `create` is False and there is no forest.
+    """
+    if not create:
+        return _ancestor_forest()
+    if _forest is None and not _dataset_cache:
+        index(compact=True)
+    return _ancestor_forest(force=True)
+
+
+# The forest indexed by index(compact=True)
+_forest = None
+
+# IDs of the children of each dataset indexed by index() (without compact=True). The
+# tuples are replaced when children are added (under _index_lock), so that other
+# threads can read them without locking.
+_children = dict()
+
+# Forest built from the cached datasets for the ancestor tables (see
+# precompute_ancestors()). Dropped whenever index() changes the cache.
+_cache_forest = None
+_ancestor_tables_enabled = False
+
+
+def precompute_ancestors(types=None):
+    """Use precomputed tables to look up closest ancestors of a type.
+
+    After this, :meth:`Dataset.closest_ancestor_of_type` is an O(1) lookup for all
+    cached datasets. The tables are built from the cached datasets, so call
+    :func:`index` first. They are rebuilt after the cache was changed by :func:`index`
+    or :func:`refresh`. With `index(compact=True)` the tables are always used.
+
+    Parameters
+    ----------
+    types : list of str or DatasetStateType, optional
+        Types to compute the tables for now. The tables for other types are computed
+        when they are first needed. By default compute them for all cached types.
+    """
+    global _ancestor_tables_enabled
+
+    _ancestor_tables_enabled = True
+    forest = _ancestor_forest()
+
+    if types is None:
+        types = list(_type_cache_by_id.copy().values())
+    for type_ in types:
+        if isinstance(type_, str):
+            type_ = DatasetStateType.from_name(type_)
+        forest.closest_ancestor_table(type_.id)
+
+
+def _ancestor_forest(force=False):
+    """Get the forest to use for ancestor lookups, building it if necessary.
+
+    Returns `None` if there is no indexed forest and the ancestor tables are not
+    enabled (unless `force`).
+    """
+    global _cache_forest
+
+    if _forest is not None:
+        return _forest
+    if not (_ancestor_tables_enabled or force):
+        return None
+    forest = _cache_forest
+    if forest is None:
+        forest = _forest_from_cache()
+        _cache_forest = forest
+    return forest
+
+
+def _uncached_ancestors(ds_ids):
+    """Get the IDs of all datasets whose ancestry is not fully cached."""
+    missing = set()
+    for ds_id in ds_ids:
+        d = _dataset_cache.get(ds_id)
+        while d is not None and not d.root and d.base_dset_id is not None:
+            if d._base_dataset is not None:
+                d = d._base_dataset
+                continue
+            base = _dataset_cache.get(d.base_dset_id)
+            if base is None:
+                break
+            d._base_dataset = base
+            d = base
+        if d is None:
+            missing.add(ds_id)
+        elif not d.root and d.base_dset_id is not None:
+            missing.add(d.base_dset_id)
+    return missing
+
+
+def _fetch_ancestors_cte(ds_ids):
+    """Fetch datasets and their ancestors, states and types with a recursive CTE.
+
+    Returns an iterable of (dataset, state, type) tuples.
+    """
+    Base = orm.Dataset.alias()
+    base_case = (
+        Base.select(Base.id, Base.base_dset)
+        .where(Base.id.in_(ds_ids))
+        .cte("ancestors", recursive=True)
+    )
+    Parent = orm.Dataset.alias()
+    recursive = Parent.select(Parent.id, Parent.base_dset).join(
+        base_case, on=(Parent.id == base_case.c.base_dset_id)
+    )
+    cte = base_case.union(recursive)
+
     query = (
-        orm.Dataset.select(orm.Dataset, orm.DatasetStateType.name.alias("_type"))
+        orm.Dataset.select(
+            orm.Dataset.id,
+            orm.Dataset.root,
+            orm.Dataset.state,
+            orm.Dataset.time,
+            orm.Dataset.base_dset,
+            orm.DatasetState.type,
+            orm.DatasetState.time,
+            orm.DatasetStateType.name,
+        )
+        .join(cte, on=(orm.Dataset.id == cte.c.id))
+        .switch(orm.Dataset)
+        .join(orm.DatasetState)
+        .join(orm.DatasetStateType, peewee.JOIN.LEFT_OUTER)
+        .with_cte(cte)
+        .tuples()
+    )
+    # Build the objects by hand, so that peewee doesn't attach the data-less states to
+    # the datasets.
+    for ds_id, root, state_id, time, base_id, type_id, state_time, name in query:
+        d = Dataset(id=ds_id, root=root, state=state_id, time=time, base_dset=base_id)
+        state = DatasetState(id=state_id, type=type_id, time=state_time)
+        type_ = None
+        if type_id is not None:
+            type_ = DatasetStateType(id=type_id, name=name)
+        yield d, state, type_
+
+
+def _fetch_ancestors_by_level(ds_ids):
+    """Fetch datasets and their ancestors level by level with batched queries.
+
+    Fallback for database backends without support for recursive CTEs.
+    Returns an iterable of (dataset, state, type) tuples.
+    """
+    datasets = dict()
+    level = set(ds_ids)
+    while level:
+        for chunk in _chunks(list(level)):
+            for d in Dataset.select().where(Dataset.id.in_(chunk)):
+                datasets[d.id] = d
+        level = {
+            d.base_dset_id
+            for d in datasets.values()
+            if not d.root
+            and d.base_dset_id is not None
+            and d.base_dset_id not in datasets
+            and d.base_dset_id not in _dataset_cache
+        }
+
+    states = dict()
+    state_ids = list({d.state_id for d in datasets.values()})
+    for chunk in _chunks(state_ids):
+        query = DatasetState.select(*_state_fields(False)).where(
+            DatasetState.id.in_(chunk)
+        )
+        for s in query:
+            states[s.id] = s
+
+    types = dict()
+    type_ids = list({s.type_id for s in states.values() if s.type_id is not None})
+    for chunk in _chunks(type_ids):
+        for t in DatasetStateType.select().where(DatasetStateType.id.in_(chunk)):
+            types[t.id] = t
+
+    for d in datasets.values():
+        state = states.get(d.state_id)
+        yield d, state, None if state is None else types.get(state.type_id)
+
+
+def prefetch_ancestors(ds_ids):
+    """Pre-fetch and cache datasets and all of their ancestors.
+
+    Ancestors that are already cached are not fetched again. The datasets, their states
+    (without .data) and the state types are fetched with a single recursive query. If
+    the database doesn't support recursive CTEs this falls back to one batched query per
+    tree level.
+
+    Parameters
+    ----------
+    ds_ids : iterable of str
+        Dataset IDs.
+    """
+    missing = list(_uncached_ancestors(ds_ids))
+    if not missing:
+        return
+
+    _logger.debug(f"Loading ancestors of {len(missing)} datasets from database...")
+    try:
+        rows = []
+        for chunk in _chunks(missing):
+            rows.extend(_fetch_ancestors_cte(chunk))
+    except (peewee.OperationalError, peewee.ProgrammingError) as err:
+        _logger.debug(f"Recursive query failed ({err}), fetching level by level.")
+        rows = list(_fetch_ancestors_by_level(missing))
+
+    _group_deferred(state for _, state, _ in rows if state is not None)
+
+    # Use the already cached objects where another thread was faster
+    datasets = dict()
+    for d, state, type_ in rows:
+        if type_ is not None:
+            _type_cache.setdefault(type_.name, type_)
+            _type_cache_by_id.setdefault(type_.id, type_)
+            d._type = type_.name
+            d._type_id = type_.id
+        if state is not None:
+            _state_cache.setdefault(state.id, state)
+        datasets[d.id] = _dataset_cache.setdefault(d.id, d)
+
+    # De-reference the base datasets
+    for d in datasets.values():
+        if not d.root and d.base_dset_id is not None and d._base_dataset is None:
+            base = datasets.get(d.base_dset_id)
+            if base is None:
+                base = _dataset_cache.get(d.base_dset_id)
+            d._base_dataset = base
+
+
+def index(since=None, snapshot=None, compact=None, stream=False, chunk_size=None):
+    """Pre-fetch and cache all Dataset(State(Type))s.
+
+    Safe to call while other threads use the cache: the new datasets are fully linked
+    before they replace the cached ones.
+
+    Parameters
+    ----------
+    since : datetime, optional
+        Only fetch datasets and states with a (broker) time not older than this and add
+        them to the cache. See also :func:`refresh`.
+    snapshot : str, optional
+        Path to a snapshot file (see :mod:`chimedb.dataset.snapshot`). If it exists and
+        is valid, the datasets are loaded from it and only rows newer than the snapshot
+        are fetched from the database. The snapshot is (re-)written if it was missing,
+        invalid or out of date.
+    compact : bool, optional
+        Keep the index in a compact :class:`chimedb.dataset.forest.DatasetForest`
+        instead of creating Dataset objects for all rows. Dataset objects are then
+        created (and cached) on demand. See :func:`dataset_forest`. By default the
+        current mode is kept (Dataset objects if nothing was indexed yet). `False`
+        switches back to Dataset objects, fetching all rows (ignoring `since`).
+    stream : bool
+        Stream the rows from the database with a server-side cursor and process them in
+        chunks, instead of buffering the whole result set. This reduces the peak memory
+        use. Implied if `chunk_size` is given.
+    chunk_size : int, optional
+        Number of rows per chunk when streaming. Default: `_STREAM_CHUNK_SIZE`.
+    """
+    global _forest, _cache_forest
+
+    if stream or chunk_size:
+        chunk_size = chunk_size or _STREAM_CHUNK_SIZE
+    with _index_lock:
+        if compact is None:
+            compact = _forest is not None
+        elif not compact and _forest is not None:
+            # back to Dataset objects for all rows
+            _forest = None
+            _cache_forest = None
+            _closest_cache.clear()
+            since = None
+
+        if snapshot is not None:
+            _index_with_snapshot(snapshot, compact, chunk_size)
+        elif compact:
+            _index_compact(since, chunk_size)
+        elif chunk_size:
+            forest = DatasetForest.from_query(since, chunk_size)
+            _publish(*_models_from_forest(forest))
+        else:
+            _publish(*_fetch_index(since))
+    _log_peak_rss("index")
+
+
+# default number of rows per chunk for index(stream=True)
+_STREAM_CHUNK_SIZE = 100000
+
+
+def _log_peak_rss(stage):
+    """Log the peak resident set size of the process.
+
+    The value in bytes is attached to the log record as `peak_rss`, so it can be picked
+    up by a logging handler or filter.
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform != "darwin":
+        peak *= 1024
+    _logger.debug(
+        f"Peak RSS after {stage}: {peak / 2**20:.1f} MiB",
+        extra={"peak_rss": peak, "stage": stage},
+    )
+
+
+def refresh():
+    """Fetch the datasets and states added since the last :func:`index` or refresh.
+
+    New datasets are linked to their already cached base datasets. Rows with a time up
+    to `_REFRESH_OVERLAP` before the newest cached dataset are fetched again, in case
+    they were inserted late. Does a full :func:`index` if nothing was indexed yet.
+
+    Datasets that are indexed already are skipped, so the ancestor lookups remain valid
+    and a refresh that finds no new datasets changes nothing.
+    """
+    with _index_lock:
+        since = None if _watermark is None else _watermark - _REFRESH_OVERLAP
+        if _forest is not None:
+            _index_compact(since)
+        else:
+            _publish(*_fetch_index(since), refresh=since is not None)
+
+
+class IndexRefresher(threading.Thread):
+    """Background thread calling :func:`refresh` periodically.
+
+    Parameters
+    ----------
+    interval : float
+        Time between refreshes in seconds.
+    """
+
+    def __init__(self, interval=10.0):
+        super().__init__(name="chimedb.dataset refresher", daemon=True)
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        """Refresh until stopped."""
+        while not self._stop_event.wait(self.interval):
+            try:
+                refresh()
+            except Exception as err:
+                _logger.warning(f"Failed to refresh dataset index: {err}")
+
+    def stop(self, timeout=None):
+        """Stop refreshing and wait for the thread to finish."""
+        self._stop_event.set()
+        self.join(timeout)
+
+
+def start_refresher(interval=10.0):
+    """Start refreshing the cache in a background thread.
+
+    Parameters
+    ----------
+    interval : float
+        Time between refreshes in seconds.
+
+    Returns
+    -------
+    IndexRefresher
+        The running thread. Call its `stop()` method to end it.
+    """
+    refresher = IndexRefresher(interval)
+    refresher.start()
+    return refresher
+
+
+async def refresh_periodically(interval=10.0):
+    """Refresh the cache periodically from an asyncio task.
+
+    The queries run in the default executor, so they don't block the event loop. Cancel
+    the task to stop.
+
+    Parameters
+    ----------
+    interval : float
+        Time between refreshes in seconds.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(None, refresh)
+        except Exception as err:
+            _logger.warning(f"Failed to refresh dataset index: {err}")
+
+
+def _fetch_index(since=None):
+    """Fetch datasets, states (without .data) and types from the database.
+
+    Parameters
+    ----------
+    since : datetime, optional
+        Only fetch datasets and states with a time not older than this.
+
+    Returns
+    -------
+    datasets, states, types : dict
+        By ID.
+    """
+    query = (
+        orm.Dataset.select(
+            orm.Dataset,
+            orm.DatasetStateType.name.alias("_type"),
+            orm.DatasetStateType.id.alias("_type_id"),
+        )
         .join(orm.DatasetState)
         .join(orm.DatasetStateType)
     )
+    state_query = DatasetState.select(DatasetState.id, DatasetState.type_id)
+    if since is not None:
+        query = query.where(orm.Dataset.time >= since)
+        state_query = state_query.where(DatasetState.time >= since)
 
     # Create a mapping from dataset ID to
     dsdict = {d.id: d for d in query.objects(Dataset)}
 
+    # Pre-fetch all states without their .data
+    states = {s.id: s for s in state_query}
+
+    # Pre-fetch types
+    types = {t.id: t for t in DatasetStateType.select()}
+
+    return dsdict, states, types
+
+
+def _publish(datasets, states, types, refresh=False):
+    """Link datasets to their base datasets and add everything to the caches.
+
+    With `refresh`, cached datasets are kept instead of being replaced. Only adding
+    datasets doesn't change the closest ancestors of the others, so these lookups are
+    kept as well.
+    """
+    global _cache_forest
+
+    # Add the datasets to the children index, including those loaded on demand before
+    new_children = dict()
+    for d in datasets.values():
+        if not d.root and d.base_dset_id is not None:
+            new_children.setdefault(d.base_dset_id, []).append(d.id)
+    if refresh:
+        datasets = {
+            ds_id: d for ds_id, d in datasets.items() if ds_id not in _dataset_cache
+        }
+
     # De-reference the base datasets
-    for d in dsdict.values():
-        base_dset = None if d.root or d.base_dset_id is None else dsdict[d.base_dset_id]
+    for d in datasets.values():
+        base_dset = None
+        if not d.root and d.base_dset_id is not None:
+            base_dset = datasets.get(d.base_dset_id)
+            if base_dset is None:
+                # Not linked if it isn't cached either, it will be loaded on access.
+                base_dset = _dataset_cache.get(d.base_dset_id)
         d._base_dataset = base_dset
-    _dataset_cache.update(dsdict)
 
-    # Pre-fetch all states without their .data and fill cache
-    for s in DatasetState.select(DatasetState.id, DatasetState.type_id):
-        _state_cache[s.id] = s
+    for base_id, child_ids in new_children.items():
+        known = _children.get(base_id, ())
+        if known:
+            # refresh() fetches some of the last rows again
+            known_ids = set(known)
+            child_ids = [c for c in child_ids if c not in known_ids]
+        if child_ids:
+            _children[base_id] = known + tuple(child_ids)
+
+    _dataset_cache.update(datasets)
+    # Don't replace cached states, they may hold their .data
+    with _state_cache.lock:
+        for state_id, state in states.items():
+            _state_cache.setdefault(state_id, state)
+    _type_cache.update({t.name: t for t in types.values()})
+    _type_cache_by_id.update(types)
+    if not datasets:
+        return
+
+    if not refresh:
+        # The ancestor tables don't include the new datasets
+        _cache_forest = None
+        _closest_cache.clear()
+    elif _cache_forest is not None:
+        new = list(datasets.values())
+        _cache_forest = _cache_forest.extend(
+            DatasetForest.from_datasets(
+                new,
+                [_dataset_type_id(d) for d in new],
+                {t.id: t.name for t in _type_cache_by_id.copy().values()},
+            )
+        )
 
-    # Pre-fetch and cache types
-    for t in DatasetStateType.select():
-        _type_cache[t.name] = t
-        _type_cache_by_id[t.id] = t
+    times = [d.time for d in datasets.values() if d.time is not None]
+    if times:
+        _update_watermark(max(times))
+
+
+def _update_watermark(time):
+    """Advance the watermark to `time` if it is newer."""
+    global _watermark
+
+    if time is not None and (_watermark is None or time > _watermark):
+        _watermark = time
+
+
+def _index_compact(since=None, chunk_size=None):
+    """Index into a forest, extending the current one if only fetching new rows."""
+    forest = DatasetForest.from_query(since, chunk_size)
+    if since is not None and _forest is not None:
+        forest = _forest.extend(forest)
+        if forest is not _forest:
+            _publish_forest(forest, extended=True)
+    else:
+        _publish_forest(forest)
+
+
+def _publish_forest(forest, extended=False):
+    """Make a forest the current index.
+
+    If `extended`, the forest only adds datasets to the current one and the remembered
+    closest ancestors are kept.
+    """
+    global _forest, _cache_forest
+
+    types = {
+        type_id: DatasetStateType(id=type_id, name=name)
+        for type_id, name in forest.types.items()
+    }
+    _type_cache.update({t.name: t for t in types.values()})
+    _type_cache_by_id.update(types)
+
+    _forest = forest
+    _cache_forest = None
+    if not extended:
+        _closest_cache.clear()
+    _update_watermark(forest.watermark)
+
+
+# Rows with a broker timestamp up to this long before the newest row in a snapshot are
+# fetched again, in case they were inserted into the database late.
+_SNAPSHOT_OVERLAP = datetime.timedelta(minutes=10)
+
+
+def _index_with_snapshot(path, compact=False, chunk_size=None):
+    """Index from a snapshot file and the rows newer than it."""
+    try:
+        forest = DatasetForest.load(path)
+    except snapshot.SnapshotError as err:
+        _logger.info(f"Not using dataset snapshot: {err}")
+        forest = None
+
+    if forest is None:
+        forest = DatasetForest.from_query(chunk_size=chunk_size)
+        outdated = True
+    else:
+        since = forest.watermark
+        if since is not None:
+            since -= _SNAPSHOT_OVERLAP
+        new = DatasetForest.from_query(since, chunk_size)
+        _logger.debug(
+            f"Loaded {len(forest)} datasets from snapshot {path}, "
+            f"{len(new)} from the database."
+        )
+        outdated = bool((forest.positions(new.ids) < 0).any())
+        if outdated:
+            forest = forest.merge(new)
+
+    if outdated:
+        try:
+            forest.save(path)
+            # use the memory-mapped version that other processes share
+            forest = DatasetForest.load(path)
+        except (OSError, snapshot.SnapshotError) as err:
+            _logger.warning(f"Failed to write dataset snapshot {path}: {err}")
+
+    if compact:
+        _publish_forest(forest)
+    else:
+        _publish(*_models_from_forest(forest))
+
+
+def _models_from_forest(forest):
+    """Create datasets, states and types from a forest."""
+    types = {
+        type_id: DatasetStateType(id=type_id, name=name)
+        for type_id, name in forest.types.items()
+    }
+
+    state_ids = forest.state_ids.astype("U32").tolist()
+    state_type = forest.state_type.tolist()
+    states = {
+        state_id: DatasetState(id=state_id, type=None if type_id < 0 else type_id)
+        for state_id, type_id in zip(state_ids, state_type)
+    }
+
+    ids = forest.ids.astype("U32").tolist()
+    datasets = dict()
+    for i, (ds_id, parent, root, time, state) in enumerate(
+        zip(
+            ids,
+            forest.parent.tolist(),
+            forest.root.tolist(),
+            forest.time.tolist(),
+            forest.state.tolist(),
+        )
+    ):
+        d = Dataset(
+            id=ds_id,
+            root=root,
+            time=time,
+            state=state_ids[state],
+            base_dset=ids[parent] if parent >= 0 else forest.unresolved.get(i),
+        )
+        d._type = forest.types.get(state_type[state])
+        if state_type[state] >= 0:
+            d._type_id = state_type[state]
+        datasets[ds_id] = d
+
+    return datasets, states, types
 
 
 class DatasetCache(Mapping):
-    """Read-only access to the dataset cache."""
+    """Read-only access to the dataset cache.
+
+    After `index(compact=True)` this covers all datasets of the forest. Their Dataset
+    objects are created on access.
+    """
 
     def __init__(self):
-        if not _dataset_cache:
+        if not _dataset_cache and _forest is None:
             index()
 
     def __getitem__(self, key):
-        return _dataset_cache[key]
+        forest = _forest
+        if forest is None:
+            return _dataset_cache[key]
+        if not isinstance(key, str) or forest.position(key) < 0:
+            raise KeyError(key)
+        return Dataset.from_id(key)
 
     def __len__(self):
-        return len(_dataset_cache)
+        forest = _forest
+        return len(_dataset_cache) if forest is None else len(forest)
 
     def __iter__(self):
-        return iter(_dataset_cache)
+        forest = _forest
+        if forest is None:
+            return iter(_dataset_cache)
+        return (ds_id.decode() for ds_id in forest.ids)
 
 
 def get_dataset(ds_id):
@@ -3,7 +3,17 @@
 # Imports
 # =======
 
-from .orm import DatasetStateType, DatasetState, Dataset
+from collections import namedtuple
+from collections.abc import Mapping
+import os
+import queue
+import threading
+import time
+
+import peewee
+
+from . import get, orm
+from .orm import DatasetStateType, DatasetState, DatasetStatePayload, Dataset
 
 # Logging
 # =======
@@ -32,19 +42,10 @@ def insert_state(state_id, state_type, time, state):
         The state.
     """
     # Make sure state type known to DB
-    state_type, _ = DatasetStateType.get_or_create(name=state_type)
-
-    # Add this state to the DB. Only send it if not known to DB yet. This is not atomic,
-    # but saves us from sending too much data in most cases.
-    if (
-        len(
-            list(
-                DatasetState.select(DatasetState.id).where(DatasetState.id == state_id)
-            )
-        )
-        == 0
-    ):
-        DatasetState.get_or_create(id=state_id, time=time, type=state_type, data=state)
+    state_type = _resolve_types([state_type])[state_type]
+
+    # A single INSERT that does nothing if the state exists already
+    _write_states([{"id": state_id, "type": state_type, "time": time, "data": state}])
 
 
 def insert_dataset(ds_id, base_dset, is_root, state, time):
@@ -71,18 +72,645 @@ def insert_dataset(ds_id, base_dset, is_root, state, time):
     Dataset.DoesNotExist
         If the base dataset is not found in the database.
     """
+    row = {
+        "id": ds_id,
+        "base_dset": base_dset or None,
+        "root": is_root,
+        "state": state,
+        "time": time,
+    }
+    # A single INSERT that does nothing if the dataset exists already. The foreign keys
+    # make sure the state and base dataset exist.
     try:
-        Dataset.get(Dataset.id == ds_id)
-    except Dataset.DoesNotExist:
-        if base_dset:
-            Dataset.get(Dataset.id == base_dset)
-        state = (
-            DatasetState.select(DatasetState.id).where(DatasetState.id == state).get()
-        )
-        Dataset.get_or_create(
-            id=ds_id,
-            state=state,
-            root=is_root,
-            time=time,
-            base_dset=base_dset,
+        _insert_ignore(Dataset, [row])
+    except peewee.IntegrityError as err:
+        _raise_missing([(ds_id, base_dset, is_root, state, time)], err)
+
+
+def _raise_missing(datasets, err):
+    """Raise the DoesNotExist error for a failed insert of datasets.
+
+    Only called after an insert failed, so the extra queries don't slow down inserts.
+    """
+    states = {d[3] for d in datasets}
+    found = {
+        s.id
+        for s in DatasetState.select(DatasetState.id).where(DatasetState.id.in_(states))
+    }
+    if states - found:
+        raise DatasetState.DoesNotExist(
+            f"States {sorted(states - found)} not found in database."
+        ) from err
+
+    in_batch = {d[0] for d in datasets}
+    bases = {d[1] for d in datasets if d[1] and not d[2]} - in_batch
+    found = {d.id for d in Dataset.select(Dataset.id).where(Dataset.id.in_(bases))}
+    if bases - found:
+        raise Dataset.DoesNotExist(
+            f"Base datasets {sorted(bases - found)} not found in database."
+        ) from err
+    raise err
+
+
+# Bulk inserts
+# ============
+
+# maximum number of rows written with a single INSERT statement
+_INSERT_CHUNK_SIZE = 100
+
+InsertResult = namedtuple("InsertResult", ["inserted", "skipped"])
+InsertResult.__doc__ = """Number of rows inserted and skipped (because they existed)."""
+
+_STATE_FIELDS = ("state_id", "state_type", "time", "state")
+_DATASET_FIELDS = ("ds_id", "base_dset", "is_root", "state", "time")
+
+
+def _records(records, fields):
+    """Normalise records given as tuples or mappings to tuples."""
+    return [
+        tuple(r[f] for f in fields) if isinstance(r, Mapping) else tuple(r)
+        for r in records
+    ]
+
+
+def _unique(records):
+    """Drop records with an ID (first entry) seen before, keeping the order."""
+    seen = dict()
+    for r in records:
+        seen.setdefault(r[0], r)
+    return list(seen.values())
+
+
+def _database():
+    db = Dataset._meta.database
+    return getattr(db, "obj", db)  # unwrap a database proxy
+
+
+def _insert_ignore(model, rows, chunk_size=None):
+    """Insert rows with multi-row statements, skipping those with an existing ID.
+
+    Only duplicate primary keys are ignored. Other constraint violations (like foreign
+    keys or NOT NULL) still raise an :class:`peewee.IntegrityError`.
+
+    Returns
+    -------
+    int
+        Number of rows inserted.
+    """
+    chunk_size = chunk_size or _INSERT_CHUNK_SIZE
+    mysql = isinstance(_database(), peewee.MySQLDatabase)
+    inserted = 0
+    for i in range(0, len(rows), chunk_size):
+        query = model.insert_many(rows[i : i + chunk_size])
+        if mysql:
+            # INSERT IGNORE would also turn foreign key errors into warnings
+            query = query.on_conflict(preserve=[model._meta.primary_key])
+        else:
+            # INSERT OR IGNORE would also skip rows violating NOT NULL or UNIQUE
+            query = query.on_conflict(
+                conflict_target=[model._meta.primary_key], action="NOTHING"
+            )
+        inserted += query.as_rowcount().execute()
+    return inserted
+
+
+def _select_types(names):
+    """Get state types by name from the database.
+
+    Concurrent inserts into a table without a unique index on the name may have created
+    duplicates. The one with the lowest ID is used, so that all writers agree.
+    """
+    types = dict()
+    query = (
+        DatasetStateType.select()
+        .where(DatasetStateType.name.in_(list(names)))
+        .order_by(DatasetStateType.id.desc())
+    )
+    for t in query:
+        types[t.name] = t
+    return types
+
+
+def _resolve_types(names):
+    """Get the IDs of state types by name, creating the missing ones.
+
+    The types are looked up in the type cache of :mod:`chimedb.dataset.get` first.
+    Missing types are inserted with INSERT IGNORE and then selected again, so writers
+    creating the same new type at the same time end up with the same ID.
+    """
+    names = set(names)
+    ids = dict()
+    for name in names:
+        t = get._type_cache.get(name)
+        if t is not None:
+            ids[name] = t.id
+    missing = names - set(ids)
+    if not missing:
+        return ids
+
+    found = _select_types(missing)
+    new = missing - set(found)
+    if new:
+        _logger.debug(f"Inserting new state types {sorted(new)}.")
+        DatasetStateType.insert_many(
+            [{"name": name} for name in sorted(new)]
+        ).on_conflict_ignore().execute()
+        found.update(_select_types(new))
+
+    for name, t in found.items():
+        get._type_cache[name] = t
+        get._type_cache_by_id[t.id] = t
+        ids[name] = t.id
+    return ids
+
+
+# Store state payloads of at least this many bytes by hash (None: off)
+_dedup_min_size = None
+
+
+def configure_dedup(enabled=True, min_size=256):
+    """Store equal state payloads only once.
+
+    If enabled, the payloads of newly inserted states are written to the
+    DatasetStatePayload table by content hash and the states only reference them.
+    Readers resolve references transparently. Can also be enabled by setting the
+    environment variable `CHIMEDB_DATASET_DEDUP` to the minimum size.
+
+    Parameters
+    ----------
+    enabled : bool
+        Turn deduplication on or off.
+    min_size : int
+        Only deduplicate payloads with at least this many bytes of JSON. Smaller ones
+        are not worth the extra row.
+    """
+    global _dedup_min_size
+
+    _dedup_min_size = min_size if enabled else None
+
+
+if os.environ.get("CHIMEDB_DATASET_DEDUP"):
+    configure_dedup(min_size=int(os.environ["CHIMEDB_DATASET_DEDUP"]))
+
+
+def _write_states(rows, chunk_size=None):
+    """Insert state rows, with their payloads stored separately if deduplicating.
+
+    Returns
+    -------
+    int
+        Number of states inserted.
+    """
+    payloads = dict()
+    if _dedup_min_size is not None:
+        for row in rows:
+            data = orm.canonical_json(row["data"])
+            if len(data) >= _dedup_min_size:
+                hash = orm.payload_hash(data)
+                payloads[hash] = {"hash": hash, "data": row["data"]}
+                row["data"] = orm.PayloadReference(hash)
+    if not payloads and len(rows) <= (chunk_size or _INSERT_CHUNK_SIZE):
+        # a single statement doesn't need a transaction
+        return _insert_ignore(DatasetState, rows, chunk_size)
+
+    with _database().atomic():
+        if payloads:
+            _insert_ignore(DatasetStatePayload, list(payloads.values()), chunk_size)
+        return _insert_ignore(DatasetState, rows, chunk_size)
+
+
+def insert_states(states, chunk_size=None):
+    """
+    Insert many dataset states.
+
+    All state types are resolved (and the missing ones inserted) with one query, the
+    states are written with chunked multi-row inserts in a single transaction. States
+    that exist already are skipped.
+
+    Parameters
+    ----------
+    states : iterable of tuple or dict
+        The states, each either a tuple `(state_id, state_type, time, state)` or a dict
+        with these keys (see :func:`insert_state`).
+    chunk_size : int, optional
+        Maximum number of states per INSERT statement. Default: `_INSERT_CHUNK_SIZE`.
+
+    Returns
+    -------
+    InsertResult
+        Number of states inserted and skipped.
+    """
+    states = _records(states, _STATE_FIELDS)
+    unique = _unique(states)
+    if not unique:
+        return InsertResult(0, len(states))
+
+    # Outside of the transaction, so that a rollback can't remove cached types
+    types = _resolve_types(s[1] for s in unique)
+    rows = [
+        {"id": state_id, "type": types[type_], "time": time, "data": data}
+        for state_id, type_, time, data in unique
+    ]
+    inserted = _write_states(rows, chunk_size)
+
+    _logger.debug(f"Inserted {inserted} of {len(states)} states.")
+    return InsertResult(inserted, len(states) - inserted)
+
+
+def _topological(datasets):
+    """Order datasets so that base datasets in the same batch come first."""
+    by_id = {d[0]: d for d in datasets}
+    ordered = []
+    done = set()
+    for d in datasets:
+        # collect the chain of not yet ordered ancestors in this batch...
+        chain = []
+        while d is not None and d[0] not in done:
+            chain.append(d)
+            done.add(d[0])
+            d = by_id.get(d[1]) if d[1] and not d[2] else None
+        # ...and add it root first
+        ordered.extend(reversed(chain))
+    return ordered
+
+
+def insert_datasets(datasets, chunk_size=None):
+    """
+    Insert many datasets.
+
+    The datasets are written with chunked multi-row inserts in a single transaction,
+    base datasets contained in the batch before the datasets referencing them. Datasets
+    that exist already are skipped.
+
+    Parameters
+    ----------
+    datasets : iterable of tuple or dict
+        The datasets, each either a tuple `(ds_id, base_dset, is_root, state, time)` or
+        a dict with these keys (see :func:`insert_dataset`).
+    chunk_size : int, optional
+        Maximum number of datasets per INSERT statement. Default: `_INSERT_CHUNK_SIZE`.
+
+    Returns
+    -------
+    InsertResult
+        Number of datasets inserted and skipped.
+
+    Raises
+    ------
+    DatasetState.DoesNotExist
+        If a state is not found in the database. Nothing is inserted in this case.
+    Dataset.DoesNotExist
+        If a base dataset is not found in the database or the batch. Nothing is
+        inserted in this case.
+    """
+    datasets = _records(datasets, _DATASET_FIELDS)
+    unique = _topological(_unique(datasets))
+    if not unique:
+        return InsertResult(0, len(datasets))
+
+    rows = [
+        {
+            "id": ds_id,
+            "base_dset": base_dset or None,
+            "root": is_root,
+            "state": state,
+            "time": time,
+        }
+        for ds_id, base_dset, is_root, state, time in unique
+    ]
+    try:
+        with _database().atomic():
+            inserted = _insert_ignore(Dataset, rows, chunk_size)
+    except peewee.IntegrityError as err:
+        _raise_missing(unique, err)
+
+    _logger.debug(f"Inserted {inserted} of {len(datasets)} datasets.")
+    return InsertResult(inserted, len(datasets) - inserted)
+
+
+# Write-behind queue
+# ==================
+
+# Marks the end of the input of an InsertQueue
+_STOP = object()
+
+# Errors after which a flush is retried
+_TRANSIENT_ERRORS = (peewee.OperationalError, peewee.InterfaceError)
+
+
+class InsertQueue:
+    """Write states and datasets to the database in the background.
+
+    The `put_*` methods only add to a queue. A worker thread writes the states and
+    datasets in batches with :func:`insert_states` and :func:`insert_datasets` once
+    `max_batch` of them are waiting, the oldest waited for `max_age` seconds or
+    :meth:`flush` is called.
+
+    A dataset is only written together with or after its state and base dataset. If
+    they are not in the database yet, it is kept until they arrive, at most for
+    `max_wait` seconds.
+
+    Parameters
+    ----------
+    max_batch : int
+        Flush once this many entries are waiting.
+    max_age : float
+        Flush once the oldest entry waited this long (seconds).
+    max_size : int
+        Maximum number of entries in the queue. The `put_*` methods block when it is
+        full (or while the database is unavailable).
+    retries : int
+        Number of times a flush failing with a transient database error (like a lost
+        connection) is retried before the entries are kept for the next flush.
+    retry_delay : float
+        Seconds to wait before the first retry. Doubled for every further retry.
+    max_wait : float
+        Seconds a dataset waits for its state or base dataset before it is dropped.
+
+    Examples
+    --------
+    >>> q = InsertQueue()
+    >>> q.put_state(state_id, "inputs", time, state)
+    >>> q.put_dataset(ds_id, base_id, False, state_id, time)
+    >>> q.close()
+    """
+
+    def __init__(
+        self,
+        max_batch=100,
+        max_age=1.0,
+        max_size=10000,
+        retries=3,
+        retry_delay=0.5,
+        max_wait=600.0,
+    ):
+        self.max_batch = max_batch
+        self.max_age = max_age
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_wait = max_wait
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._states = dict()
+        self._datasets = dict()  # ID -> (record, time queued)
+        self._oldest = None
+        self._failed = False
+        self._closed = False
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "states_inserted": 0,
+            "states_skipped": 0,
+            "datasets_inserted": 0,
+            "datasets_skipped": 0,
+            "datasets_dropped": 0,
+            "flushes": 0,
+            "retries": 0,
+            "errors": 0,
+            "last_flush_latency": 0.0,
+            "max_flush_latency": 0.0,
+        }
+
+        self._thread = threading.Thread(
+            target=self._run, name="chimedb-insert-queue", daemon=True
         )
+        self._thread.start()
+
+    # Public API
+    # ==========
+
+    def put_state(self, state_id, state_type, time, state, timeout=None):
+        """Queue a dataset state. See :func:`insert_state` for the parameters.
+
+        Blocks if the queue is full, for at most `timeout` seconds.
+
+        Raises
+        ------
+        queue.Full
+            If the queue stayed full for `timeout` seconds.
+        """
+        self._put(("state", (state_id, state_type, time, state)), timeout)
+
+    def put_dataset(self, ds_id, base_dset, is_root, state, time, timeout=None):
+        """Queue a dataset. See :func:`insert_dataset` for the parameters.
+
+        Blocks if the queue is full, for at most `timeout` seconds.
+
+        Raises
+        ------
+        queue.Full
+            If the queue stayed full for `timeout` seconds.
+        """
+        self._put(("dataset", (ds_id, base_dset, is_root, state, time)), timeout)
+
+    def flush(self, timeout=None):
+        """Write everything queued so far and wait until it's done.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum time to wait in seconds.
+
+        Returns
+        -------
+        bool
+            `True` if everything was written, `False` if entries are left (because of
+            a timeout, database errors or datasets waiting for their dependencies).
+        """
+        done = threading.Event()
+        self._put(done, timeout)
+        return done.wait(timeout) and self.depth == 0
+
+    def close(self, timeout=None):
+        """Flush the queue and stop the worker thread.
+
+        Returns
+        -------
+        bool
+            `True` if everything was written.
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_STOP, timeout=timeout)
+        self._thread.join(timeout)
+        return self.depth == 0
+
+    @property
+    def depth(self):
+        """Number of states and datasets that are not written yet."""
+        return self._queue.qsize() + len(self._states) + len(self._datasets)
+
+    def stats(self):
+        """Get the counters of the queue.
+
+        Returns
+        -------
+        dict
+            Numbers of states and datasets inserted, skipped (because they existed)
+            and dropped, the number of flushes, retries and failed flushes, the duration
+            of the last and longest flush in seconds and the current queue depth.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["depth"] = self.depth
+        return stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f"<InsertQueue: {self.depth} pending>"
+
+    # Worker
+    # ======
+
+    def _put(self, item, timeout):
+        if self._closed:
+            raise RuntimeError("InsertQueue is closed.")
+        self._queue.put(item, timeout=timeout)
+
+    def _count(self, **kwargs):
+        with self._stats_lock:
+            for key, value in kwargs.items():
+                self._stats[key] += value
+
+    def _pending(self):
+        return len(self._states) + len(self._datasets)
+
+    def _run(self):
+        while True:
+            if self._failed and self._pending() >= self.max_batch:
+                # Don't take more entries while the database is unavailable, so that the
+                # queue fills up and blocks the producers.
+                time.sleep(self.retry_delay)
+                self._flush()
+                continue
+
+            timeout = None
+            if self._oldest is not None:
+                timeout = max(0, self._oldest + self.max_age - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush()
+                return
+            if isinstance(item, threading.Event):
+                self._flush()
+                item.set()
+                continue
+
+            if item is not None:
+                kind, record = item
+                if kind == "state":
+                    self._states[record[0]] = record
+                else:
+                    self._datasets[record[0]] = (record, time.monotonic())
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+
+            if item is None or self._pending() >= self.max_batch:
+                self._flush()
+
+    def _flush(self):
+        """Write all pending entries, retrying on transient errors."""
+        if not self._pending():
+            self._oldest = None
+            return
+
+        start = time.monotonic()
+        for attempt in range(self.retries + 1):
+            try:
+                self._write()
+                self._failed = False
+                break
+            except _TRANSIENT_ERRORS as err:
+                if attempt == self.retries:
+                    _logger.error(f"Failed to write {self._pending()} entries: {err}")
+                    self._count(errors=1)
+                    self._failed = True
+                    break
+                _logger.warning(f"Failed to write entries, retrying: {err}")
+                self._count(retries=1)
+                time.sleep(self.retry_delay * 2**attempt)
+            except Exception as err:
+                # Not going to succeed later: drop the batch
+                _logger.error(
+                    f"Dropping {self._pending()} entries that can't be written: {err}"
+                )
+                self._count(errors=1, datasets_dropped=len(self._datasets))
+                self._states.clear()
+                self._datasets.clear()
+                break
+
+        latency = time.monotonic() - start
+        with self._stats_lock:
+            self._stats["flushes"] += 1
+            self._stats["last_flush_latency"] = latency
+            self._stats["max_flush_latency"] = max(
+                latency, self._stats["max_flush_latency"]
+            )
+        self._oldest = time.monotonic() if self._pending() else None
+
+    def _write(self):
+        """Write the pending states, then the datasets whose dependencies exist."""
+        if self._states:
+            result = insert_states(list(self._states.values()))
+            self._count(states_inserted=result.inserted, states_skipped=result.skipped)
+            self._states.clear()
+
+        if not self._datasets:
+            return
+        datasets = [record for record, _ in self._datasets.values()]
+        try:
+            result = insert_datasets(datasets)
+        except (DatasetState.DoesNotExist, Dataset.DoesNotExist):
+            # Some of them are missing their state or base dataset
+            datasets = _ready_datasets(datasets)
+            result = insert_datasets(datasets) if datasets else InsertResult(0, 0)
+        self._count(datasets_inserted=result.inserted, datasets_skipped=result.skipped)
+        for record in datasets:
+            del self._datasets[record[0]]
+
+        now = time.monotonic()
+        expired = [
+            ds_id
+            for ds_id, (_, queued) in self._datasets.items()
+            if now - queued > self.max_wait
+        ]
+        if expired:
+            _logger.error(
+                f"Dropping {len(expired)} datasets, their state or base dataset didn't "
+                f"arrive within {self.max_wait}s: {expired[:10]}"
+            )
+            self._count(datasets_dropped=len(expired))
+            for ds_id in expired:
+                del self._datasets[ds_id]
+
+
+def _ready_datasets(datasets):
+    """Select the datasets whose state and base dataset exist (or are in the batch)."""
+    states = {s[3] for s in datasets}
+    states = {
+        s.id
+        for s in DatasetState.select(DatasetState.id).where(DatasetState.id.in_(states))
+    }
+    bases = {d[1] for d in datasets if d[1] and not d[2]}
+    known = {d.id for d in Dataset.select(Dataset.id).where(Dataset.id.in_(bases))}
+
+    # Add datasets from the batch until no more become ready
+    ready = dict()
+    waiting = [d for d in datasets if d[3] in states]
+    while True:
+        added = [
+            d for d in waiting if d[2] or not d[1] or d[1] in known or d[1] in ready
+        ]
+        if not added:
+            return list(ready.values())
+        ready.update((d[0], d) for d in added)
+        waiting = [d for d in waiting if d[0] not in ready]
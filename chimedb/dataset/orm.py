@@ -1,8 +1,18 @@
 """Table definitions for the comet datasets and states."""
 from chimedb.core.orm import base_model, JSONDictField
 
+import hashlib
+import json
+import os
+import zlib
+
 import peewee
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Logging
 # =======
 
@@ -12,6 +22,313 @@ _logger = logging.getLogger("chimedb")
 _logger.addHandler(logging.NullHandler())
 
 
+# JSON codecs.
+# ============
+
+
+class JSONCodec:
+    """Decode JSON with a given library.
+
+    State data is always encoded with the standard library: orjson and msgspec would
+    silently write NaN and infinities as null.
+
+    Parameters
+    ----------
+    name : str
+        Name of the library.
+    loads : callable
+        Decode JSON from str or bytes.
+    errors : tuple of Exception
+        Errors raised by `loads` for data the library doesn't support (like NaN), which
+        is then decoded by the standard library instead.
+    """
+
+    def __init__(self, name, loads, errors=()):
+        self.name = name
+        self._loads = loads
+        self._errors = errors
+
+    def loads(self, data):
+        """Decode JSON.
+
+        Parameters
+        ----------
+        data : str or bytes
+            JSON text.
+
+        Returns
+        -------
+        object
+            The decoded value.
+        """
+        try:
+            return self._loads(data)
+        except self._errors:
+            return json.loads(data)
+
+    def __repr__(self):
+        return f"<JSONCodec: {self.name}>"
+
+
+def _orjson_codec():
+    import orjson
+
+    return JSONCodec("orjson", orjson.loads, (orjson.JSONDecodeError,))
+
+
+def _msgspec_codec():
+    import msgspec
+
+    return JSONCodec("msgspec", msgspec.json.decode, (msgspec.DecodeError, TypeError))
+
+
+def _json_codec():
+    return JSONCodec("json", json.loads)
+
+
+JSON_CODECS = {"orjson": _orjson_codec, "msgspec": _msgspec_codec, "json": _json_codec}
+
+_codec = None
+
+
+def set_json_codec(name=None):
+    """Choose the library used to decode state data.
+
+    Can also be set with the environment variable `CHIMEDB_DATASET_JSON_CODEC`.
+
+    Parameters
+    ----------
+    name : str, optional
+        `orjson`, `msgspec` or `json`. By default the first one of these that is
+        installed.
+
+    Returns
+    -------
+    JSONCodec
+        The codec now in use.
+
+    Raises
+    ------
+    ImportError
+        If the requested library is not installed.
+    """
+    global _codec
+
+    if name is not None:
+        if name not in JSON_CODECS:
+            raise ValueError(f"Unknown JSON codec {name}.")
+        _codec = JSON_CODECS[name]()
+    else:
+        for make_codec in JSON_CODECS.values():
+            try:
+                _codec = make_codec()
+                break
+            except ImportError:
+                continue
+    _logger.debug(f"Using JSON codec {_codec.name}.")
+    return _codec
+
+
+def json_codec():
+    """Get the :class:`JSONCodec` used to decode state data."""
+    return _codec
+
+
+set_json_codec(os.environ.get("CHIMEDB_DATASET_JSON_CODEC") or None)
+
+
+# Compression of state data.
+# ==========================
+
+# Compressed payloads start with one of these prefixes. JSON text never starts with a
+# null byte, so they can't be confused with uncompressed data.
+COMPRESSION_PREFIXES = {"zlib": b"\x00ZL", "zstd": b"\x00ZS"}
+
+_compression = None
+_compression_level = None
+_compression_min_size = 1024
+
+
+def configure_compression(method=None, level=None, min_size=1024):
+    """Compress the data of newly written dataset states.
+
+    Compression is off by default. Compressed data is stored as binary, so on MySQL the
+    `data` column has to be a BLOB type first (see `dataset_utils compress-states`).
+    Compressed and uncompressed data are always read transparently.
+
+    Can also be set with the environment variable `CHIMEDB_DATASET_COMPRESSION`, e.g.
+    `zlib` or `zstd:3` (method and level).
+
+    Parameters
+    ----------
+    method : str, optional
+        `zlib` or `zstd` (requires the `zstandard` package). `None` to turn compression
+        off.
+    level : int, optional
+        Compression level. Default depends on the method.
+    min_size : int
+        Only compress payloads with at least this many bytes of JSON.
+    """
+    global _compression, _compression_level, _compression_min_size
+
+    if method is not None and method not in COMPRESSION_PREFIXES:
+        raise ValueError(f"Unknown compression method {method}.")
+    if method == "zstd" and zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package.")
+    _compression = method
+    _compression_level = level
+    _compression_min_size = min_size
+
+
+def compress(data, method, level=None):
+    """Compress bytes and add the prefix identifying the method."""
+    if method == "zlib":
+        compressed = zlib.compress(data, -1 if level is None else level)
+    else:
+        compressed = zstandard.ZstdCompressor(level=level or 3).compress(data)
+    return COMPRESSION_PREFIXES[method] + compressed
+
+
+def decompress(data):
+    """Decompress bytes written by :func:`compress`, pass through other data."""
+    prefix = bytes(data[:3])
+    if prefix == COMPRESSION_PREFIXES["zlib"]:
+        return zlib.decompress(data[3:])
+    if prefix == COMPRESSION_PREFIXES["zstd"]:
+        if zstandard is None:
+            raise ImportError("Reading zstd compressed data requires zstandard.")
+        return zstandard.ZstdDecompressor().decompress(data[3:])
+    return data
+
+
+def is_compressed(data):
+    """Tell if a raw `data` value from the database is compressed."""
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        return False
+    return bytes(data[:3]) in COMPRESSION_PREFIXES.values()
+
+
+# Deduplication of state data.
+# ============================
+
+# Data of states whose payload is stored in the DatasetStatePayload table is replaced
+# by this prefix followed by the hash of the payload.
+REFERENCE_PREFIX = "\x00RF"
+
+
+def canonical_json(value):
+    """Encode a payload as JSON with sorted keys and without whitespace."""
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode()
+
+
+def payload_hash(value):
+    """Get the content hash of a state payload.
+
+    Parameters
+    ----------
+    value : dict or bytes
+        The payload or its :func:`canonical_json`.
+
+    Returns
+    -------
+    str
+        The hex SHA-256 of the canonical JSON, so that equal dicts have the same hash.
+    """
+    if isinstance(value, dict):
+        value = canonical_json(value)
+    return hashlib.sha256(value).hexdigest()
+
+
+class PayloadReference:
+    """Reference to a payload in the DatasetStatePayload table.
+
+    Assign it to `DatasetState.data` to store the payload only once.
+
+    Parameters
+    ----------
+    hash : str
+        The hash of the payload (see :func:`payload_hash`).
+    """
+
+    def __init__(self, hash):
+        self.hash = hash
+
+    def __repr__(self):
+        return f"<PayloadReference: {self.hash}>"
+
+
+def _load_payload(hash):
+    return DatasetStatePayload.get_by_id(hash).data
+
+
+_payload_resolver = _load_payload
+
+
+def set_payload_resolver(resolver):
+    """Set the function used to get a referenced payload by its hash.
+
+    :mod:`chimedb.dataset.get` uses this to share equal payloads in memory.
+    """
+    global _payload_resolver
+
+    _payload_resolver = resolver
+
+
+def reference_hash(value):
+    """Get the payload hash if a raw value is a reference, otherwise `None`."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value)
+        if value.startswith(REFERENCE_PREFIX.encode()):
+            return value[len(REFERENCE_PREFIX) :].decode()
+    elif isinstance(value, str) and value.startswith(REFERENCE_PREFIX):
+        return value[len(REFERENCE_PREFIX) :]
+    return None
+
+
+class StateDataField(JSONDictField):
+    """A JSON dict field that stores large payloads compressed, if enabled.
+
+    See :func:`configure_compression`. Reads JSON text, JSON bytes and compressed data.
+    JSON is decoded with the codec chosen by :func:`set_json_codec`.
+    Values can also be a :class:`PayloadReference`, which is resolved when reading.
+    """
+
+    def db_value(self, value):
+        """Encode a dict (or reference) for the database, compressed if enabled."""
+        if value is None:
+            return super().db_value(value)
+        if isinstance(value, PayloadReference):
+            return REFERENCE_PREFIX + value.hash
+        if not isinstance(value, dict):
+            raise ValueError(f"Expected dict (got {type(value).__name__}).")
+        data = json.dumps(value)
+        if _compression is not None and len(data) >= _compression_min_size:
+            return compress(data.encode(), _compression, _compression_level)
+        return data
+
+    def python_value(self, value):
+        """Decode (and decompress or resolve) a value from the database."""
+        if value is None:
+            return None
+        hash = reference_hash(value)
+        if hash is not None:
+            return _payload_resolver(hash)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = decompress(bytes(value))
+        return _codec.loads(value)
+
+
+def _compression_from_env():
+    config = os.environ.get("CHIMEDB_DATASET_COMPRESSION")
+    if not config:
+        return
+    method, _, level = config.partition(":")
+    configure_compression(method, int(level) if level else None)
+
+
+_compression_from_env()
+
+
 # Tables.
 # =======
 
@@ -19,7 +336,7 @@ _logger.addHandler(logging.NullHandler())
 class DatasetStateType(base_model):
     """Model for datasetstatetype table."""
 
-    name = peewee.CharField()
+    name = peewee.CharField(unique=True)
 
     def __repr__(self):
         return f"<DatasetStateType: {self.name}>"
@@ -30,10 +347,23 @@ class DatasetState(base_model):
 
     id = peewee.FixedCharField(max_length=32, primary_key=True)
     type = peewee.ForeignKeyField(DatasetStateType, null=True)
-    data = JSONDictField()
+    data = StateDataField()
     time = peewee.DateTimeField()
 
 
+class DatasetStatePayload(base_model):
+    """Model for datasetstatepayload table.
+
+    Holds state payloads shared by several states, which reference them by hash.
+    """
+
+    hash = peewee.FixedCharField(max_length=64, primary_key=True)
+    data = StateDataField()
+
+    def __repr__(self):
+        return f"<DatasetStatePayload: {self.hash}>"
+
+
 class Dataset(base_model):
     """Model for dataset table."""
 
@@ -0,0 +1,187 @@
+"""Memory-mappable on-disk snapshots of the dataset index.
+
+A snapshot file consists of
+
+* the magic bytes `CHDSSNAP`,
+* the length of the header as a little-endian uint64,
+* a JSON header with the schema version, the high-water-mark timestamp, the state type
+  names and the dtype, shape and offset of each array,
+* the raw arrays, each aligned to `ALIGNMENT` bytes.
+
+Snapshots are written to a temporary file and atomically moved into place, so that
+many processes can share (and refresh) the same file. They are read back with
+:func:`numpy.memmap` in read-only mode.
+"""
+
+import datetime
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+# Logging
+# =======
+
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+
+MAGIC = b"CHDSSNAP"
+
+# Increment this whenever the layout or meaning of the arrays changes
+SCHEMA_VERSION = 2
+
+ALIGNMENT = 64
+
+
+class SnapshotError(Exception):
+    """A snapshot file is missing, corrupt or has an incompatible schema version."""
+
+
+class Snapshot:
+    """A loaded snapshot.
+
+    Attributes
+    ----------
+    arrays : dict of str -> np.ndarray
+        The (memory-mapped, read-only) arrays.
+    watermark : datetime or None
+        Time of the newest row contained in the snapshot.
+    types : dict of int -> str
+        Names of the state types by ID.
+    """
+
+    def __init__(self, arrays, watermark, types):
+        self.arrays = arrays
+        self.watermark = watermark
+        self.types = types
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __repr__(self):
+        sizes = ", ".join(f"{k}[{len(v)}]" for k, v in self.arrays.items())
+        return f"<Snapshot ({self.watermark}): {sizes}>"
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write(path, arrays, watermark=None, types=None):
+    """Write a snapshot file.
+
+    Parameters
+    ----------
+    path : str
+        File to write. It is replaced atomically if it exists.
+    arrays : dict of str -> np.ndarray
+        The arrays to store. Object arrays are not supported.
+    watermark : datetime, optional
+        Time of the newest row contained in the snapshot.
+    types : dict of int -> str, optional
+        Names of the state types by ID.
+    """
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    for name, a in arrays.items():
+        if a.dtype.hasobject:
+            raise ValueError(f"Can't write object array {name} to snapshot.")
+
+    # The header size depends on the offsets and vice versa. Leave enough room for the
+    # offsets and pad the header.
+    layout = {
+        name: {"dtype": a.dtype.str, "shape": list(a.shape), "offset": 0}
+        for name, a in arrays.items()
+    }
+    header = {
+        "version": SCHEMA_VERSION,
+        "watermark": None if watermark is None else watermark.isoformat(),
+        "types": {str(k): v for k, v in (types or {}).items()},
+        "arrays": layout,
+    }
+    header_len = len(json.dumps(header).encode()) + 32 * len(arrays) + 64
+    offset = _aligned(len(MAGIC) + 8 + header_len)
+    for name, a in arrays.items():
+        layout[name]["offset"] = offset
+        offset = _aligned(offset + a.nbytes)
+    header_bytes = json.dumps(header).encode().ljust(header_len)
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", header_len))
+            f.write(header_bytes)
+            for name, a in arrays.items():
+                f.seek(layout[name]["offset"])
+                f.write(a.tobytes())
+            f.truncate(offset)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    _logger.debug(f"Wrote dataset snapshot to {path} ({offset} bytes).")
+
+
+def read(path):
+    """Read a snapshot file.
+
+    Parameters
+    ----------
+    path : str
+        The snapshot file.
+
+    Returns
+    -------
+    Snapshot
+        The snapshot with read-only memory-mapped arrays.
+
+    Raises
+    ------
+    SnapshotError
+        If the file doesn't exist, is not a snapshot or has a different schema version.
+    """
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise SnapshotError(f"{path} is not a dataset snapshot.")
+            (header_len,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_len).decode())
+    except OSError as err:
+        raise SnapshotError(f"Can't read snapshot {path}: {err}") from err
+    except (struct.error, ValueError) as err:
+        raise SnapshotError(f"Corrupt snapshot {path}: {err}") from err
+
+    if header.get("version") != SCHEMA_VERSION:
+        raise SnapshotError(
+            f"Snapshot {path} has schema version {header.get('version')} "
+            f"(expected {SCHEMA_VERSION})."
+        )
+
+    size = os.path.getsize(path)
+    arrays = dict()
+    for name, layout in header["arrays"].items():
+        dtype = np.dtype(layout["dtype"])
+        shape = tuple(layout["shape"])
+        if layout["offset"] + dtype.itemsize * int(np.prod(shape)) > size:
+            raise SnapshotError(f"Snapshot {path} is truncated.")
+        if 0 in shape:
+            # can't memory map empty arrays
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(
+                path, dtype=dtype, mode="r", offset=layout["offset"], shape=shape
+            )
+
+    watermark = header["watermark"]
+    if watermark is not None:
+        watermark = datetime.datetime.fromisoformat(watermark)
+    types = {int(k): v for k, v in header["types"].items()}
+    return Snapshot(arrays, watermark, types)
@@ -1,5 +1,8 @@
 """Utility to set up for testing with a local dummy chimedb."""
 
+import logging
+import threading
+import time
 import unittest
 import tempfile
 import os
@@ -13,10 +16,9 @@ class TestChimeDB(unittest.TestCase):
 
     def setUp(self):
         """Set up chimedb.core for testing with a local dummy DB."""
-        (fd, rcfile) = tempfile.mkstemp(text=True)
+        fd, rcfile = tempfile.mkstemp(text=True)
         with os.fdopen(fd, "a") as rc:
-            rc.write(
-                """\
+            rc.write("""\
             chimedb:
                 db_type:         MySQL
                 db:              test
@@ -26,8 +28,7 @@ class TestChimeDB(unittest.TestCase):
                 passwd_rw:       ""
                 host:            127.0.0.1
                 port:            3306
-            """
-            )
+            """)
 
         # Tell chimedb where the database connection config is
         assert os.path.isfile(rcfile), f"Could not find {rcfile}."
@@ -40,3 +41,41 @@ class TestChimeDB(unittest.TestCase):
 
         db.orm.create_tables("chimedb.dataset")
         dget.index()
+
+
+class QueryCounter(logging.Handler):
+    """Count the queries peewee sends, slowing each of them down a little."""
+
+    def __init__(self, delay=0.0):
+        super().__init__(logging.DEBUG)
+        self.delay = delay
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        """Record a query."""
+        with self._lock:
+            self.queries.append(record.msg)
+        time.sleep(self.delay)
+
+    def count(self, table, where=True):
+        """Count queries selecting from `table` (with a WHERE clause if `where`)."""
+        n = 0
+        for sql, _ in self.queries:
+            if not sql.startswith("SELECT") or " FROM " not in sql:
+                continue
+            from_table = sql.split(" FROM ")[1].split()[0].strip('"`')
+            if from_table == table and (not where or " WHERE " in sql):
+                n += 1
+        return n
+
+    def __enter__(self):
+        self.logger = logging.getLogger("peewee")
+        self.level = self.logger.level
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self)
+        return self
+
+    def __exit__(self, *args):
+        self.logger.removeHandler(self)
+        self.logger.setLevel(self.level)
@@ -1,11 +1,20 @@
 """Dataset utils and click scripts."""
 
 import click
+import json
 
 import numpy as np
+import peewee
 
 from chimedb.core import connect as connect_db, close as close_db
-from chimedb.dataset.get import Dataset, DatasetCache
+from chimedb.core.exceptions import NotFoundError
+from chimedb.dataset import orm
+from chimedb.dataset.get import (
+    Dataset,
+    DatasetStateType,
+    dataset_forest,
+    prefetch_ancestors,
+)
 
 
 @click.group()
@@ -16,34 +25,278 @@ def cli():
 
 @cli.command()
 @click.argument("dataset_id")
-def treesize(dataset_id):
+@click.option(
+    "--json",
+    "as_json",
+    is_flag=True,
+    help="Print the tree size and the number of nodes per depth as JSON.",
+)
+def treesize(dataset_id, as_json):
     """Print number of nodes in the tree containing DATASET_ID."""
-    click.echo(f"Counting tree size of node {dataset_id}...")
+    if not as_json:
+        click.echo(f"Counting tree size of node {dataset_id}...")
     connect_db()
 
-    # Get all datasets cached from DB
-    all_nodes = DatasetCache()
+    # Get all datasets from DB
+    forest = dataset_forest()
+    close_db()
 
-    click.echo(f"Total number of nodes in DB: {len(all_nodes)}")
+    i = forest.position(dataset_id)
+    if i < 0:
+        raise click.ClickException(f"Dataset {dataset_id} not found.")
+
+    # Find the root, then count the nodes of each depth breadth-first
+    root = forest.root_of(i)
+    depths = [len(level) for level in forest.levels(root)]
+
+    if as_json:
+        click.echo(
+            json.dumps(
+                {
+                    "dataset": dataset_id,
+                    "root": forest.id(root),
+                    "total": len(forest),
+                    "size": sum(depths),
+                    "depths": depths,
+                }
+            )
+        )
+        return
+
+    click.echo(f"Total number of nodes in DB: {len(forest)}")
+    if forest.parent[root] < 0 and not forest.root[root]:
+        click.echo(f"Warning: base dataset of {forest.id(root)} not found.")
+    click.echo(f"Tree size: {sum(depths)}")
+
+
+@cli.command("compress-states")
+@click.option(
+    "--method",
+    type=click.Choice(sorted(orm.COMPRESSION_PREFIXES)),
+    default="zlib",
+    show_default=True,
+    help="Compression method.",
+)
+@click.option("--level", type=int, default=None, help="Compression level.")
+@click.option(
+    "--min-size",
+    type=int,
+    default=1024,
+    show_default=True,
+    help="Only compress states with at least this many bytes of data.",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=500,
+    show_default=True,
+    help="Number of states rewritten per transaction.",
+)
+@click.option(
+    "--dry-run", is_flag=True, help="Only report the compression ratio per state type."
+)
+def compress_states(method, level, min_size, batch_size, dry_run):
+    """Compress the data of the dataset states in the database.
+
+    On MySQL the data column is changed to LONGBLOB first. States are then rewritten
+    in batches, already compressed ones are skipped. Enable compression for new states
+    with chimedb.dataset.orm.configure_compression (or CHIMEDB_DATASET_COMPRESSION).
+    """
+    connect_db(read_write=not dry_run)
+    db = orm.DatasetState._meta.database
+    db = getattr(db, "obj", db)  # unwrap a database proxy
+
+    if not dry_run and isinstance(db, peewee.MySQLDatabase):
+        _blob_data_column(db)
+
+    types = {t.id: t.name for t in orm.DatasetStateType.select()}
+    sizes = dict()  # type name -> [states, uncompressed bytes, compressed bytes]
+    for rows in _raw_states(db, batch_size):
+        last = rows[-1][0]
+        updates = []
+        for state_id, type_id, data in rows:
+            if orm.reference_hash(data) is not None:
+                # deduplicated, see dedup-states
+                continue
+            if orm.is_compressed(data):
+                compressed, data = data, orm.decompress(data)
+            elif len(data) >= min_size:
+                compressed = orm.compress(data, method, level)
+                updates.append((state_id, compressed))
+            else:
+                compressed = data
+            size = sizes.setdefault(types.get(type_id, "unknown"), [0, 0, 0])
+            size[0] += 1
+            size[1] += len(data)
+            size[2] += len(compressed)
+
+        if updates and not dry_run:
+            with db.atomic():
+                for state_id, compressed in updates:
+                    # bypass the field conversion, the data is compressed already
+                    orm.DatasetState.update(
+                        {orm.DatasetState.data: peewee.Value(compressed)}
+                    ).where(orm.DatasetState.id == state_id).execute()
+        click.echo(
+            f"{'Would compress' if dry_run else 'Compressed'} {len(updates)} of "
+            f"{len(rows)} states up to {last}."
+        )
+    close_db()
 
-    start_node = Dataset.from_id(dataset_id)
-    tree = set()
+    click.echo(
+        f"{'type':<40} {'states':>8} {'MiB':>10} {'compressed':>10} {'ratio':>6}"
+    )
+    for name, (n, size, compressed) in sorted(sizes.items()):
+        click.echo(
+            f"{name:<40} {n:>8} {size / 2**20:>10.2f} {compressed / 2**20:>10.2f} "
+            f"{size / max(compressed, 1):>6.2f}"
+        )
 
-    # traverse to root first
-    node = start_node
-    tree.add(node)
-    while not node.root:
-        node = node.base_dataset
-        tree.add(node)
 
-    for n in all_nodes.values():
-        if n in tree:
-            continue
-        if in_tree(n, tree):
-            tree.add(n)
+def _raw_states(db, batch_size):
+    """Iterate over batches of (id, type ID, data) of the states in the database.
+
+    The data is not decoded, it is returned as bytes as stored in the database.
+    """
+    last = ""
+    while True:
+        query = (
+            orm.DatasetState.select(
+                orm.DatasetState.id, orm.DatasetState.type, orm.DatasetState.data
+            )
+            .where(orm.DatasetState.id > last)
+            .order_by(orm.DatasetState.id)
+            .limit(batch_size)
+        )
+        rows = list(db.execute_sql(*query.sql()))
+        if not rows:
+            return
+        last = rows[-1][0]
+        yield [
+            (state_id, type_id, data.encode() if isinstance(data, str) else data)
+            for state_id, type_id, data in rows
+        ]
+
+
+@cli.command("dedup-states")
+@click.option(
+    "--min-size",
+    type=int,
+    default=256,
+    show_default=True,
+    help="Only deduplicate states with at least this many bytes of data.",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=500,
+    show_default=True,
+    help="Number of states read (and rewritten) at once.",
+)
+@click.option(
+    "--apply",
+    is_flag=True,
+    help="Move payloads shared by several states to the datasetstatepayload table.",
+)
+def dedup_states(min_size, batch_size, apply):
+    """Report how much space storing equal state payloads once would save.
+
+    With --apply, payloads shared by several states are moved to the
+    datasetstatepayload table and the states reference them by hash. Enable this for
+    new states with chimedb.dataset.insert.configure_dedup (or CHIMEDB_DATASET_DEDUP).
+    """
+    connect_db(read_write=apply)
+    db = orm.DatasetState._meta.database
+    db = getattr(db, "obj", db)  # unwrap a database proxy
+    if apply:
+        db.create_tables([orm.DatasetStatePayload], safe=True)
+
+    # Hash all payloads
+    types = {t.id: t.name for t in orm.DatasetStateType.select()}
+    states = dict()  # state ID -> (type name, hash, size or None if deduplicated)
+    for rows in _raw_states(db, batch_size):
+        for state_id, type_id, data in rows:
+            hash = orm.reference_hash(data)
+            if hash is None:
+                data = orm.canonical_json(
+                    orm.json_codec().loads(bytes(orm.decompress(data)))
+                )
+                size, hash = len(data), orm.payload_hash(data)
+            else:
+                size = None
+            states[state_id] = (types.get(type_id, "unknown"), hash, size)
+    payload_sizes = (
+        {
+            p.hash: len(orm.canonical_json(p.data))
+            for p in orm.DatasetStatePayload.select()
+        }
+        if orm.DatasetStatePayload.table_exists()
+        else dict()
+    )
 
+    # type name -> [states, distinct payloads, bytes, bytes when deduplicated]
+    report = dict()
+    count = dict()
+    for _, hash, _ in states.values():
+        count[hash] = count.get(hash, 0) + 1
+    seen = set()
+    duplicates = []
+    for state_id, (name, hash, size) in states.items():
+        inline = size is not None
+        if not inline:
+            size = payload_sizes.get(hash, 0)
+        entry = report.setdefault(name, [0, 0, 0, 0])
+        entry[0] += 1
+        entry[2] += size
+        if hash not in seen:
+            seen.add(hash)
+            entry[1] += 1
+            entry[3] += size
+        elif size < min_size:
+            entry[3] += size
+        if inline and count[hash] > 1 and size >= min_size:
+            duplicates.append(state_id)
+
+    if apply and duplicates:
+        click.echo(f"Moving payloads of {len(duplicates)} states...")
+        for i in range(0, len(duplicates), batch_size):
+            chunk = duplicates[i : i + batch_size]
+            query = orm.DatasetState.select(
+                orm.DatasetState.id, orm.DatasetState.data
+            ).where(orm.DatasetState.id.in_(chunk))
+            with db.atomic():
+                for state in query:
+                    hash = states[state.id][1]
+                    orm.DatasetStatePayload.insert(
+                        hash=hash, data=state.data
+                    ).on_conflict_ignore().execute()
+                    orm.DatasetState.update(data=orm.PayloadReference(hash)).where(
+                        orm.DatasetState.id == state.id
+                    ).execute()
     close_db()
-    click.echo(f"Tree size: {len(tree)}")
+
+    click.echo(
+        f"{'type':<40} {'states':>8} {'distinct':>8} {'MiB':>10} {'dedup MiB':>10} "
+        f"{'saved':>6}"
+    )
+    for name, (n, distinct, size, dedup) in sorted(report.items()):
+        click.echo(
+            f"{name:<40} {n:>8} {distinct:>8} {size / 2**20:>10.2f} "
+            f"{dedup / 2**20:>10.2f} {1 - dedup / max(size, 1):>6.1%}"
+        )
+
+
+def _blob_data_column(db):
+    """Change the type of the data column of the states to LONGBLOB on MySQL."""
+    table = orm.DatasetState._meta.table_name
+    data_type = db.execute_sql(
+        "SELECT DATA_TYPE FROM information_schema.COLUMNS WHERE "
+        "TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = 'data'",
+        (table,),
+    ).fetchone()[0]
+    if data_type.lower() != "longblob":
+        click.echo(f"Changing type of {table}.data from {data_type} to LONGBLOB...")
+        db.execute_sql(f"ALTER TABLE `{table}` MODIFY `data` LONGBLOB NOT NULL")
 
 
 def in_tree(node, tree):
@@ -73,6 +326,9 @@ def in_tree(node, tree):
     return False
 
 
+NULL_DATASET = "00000000000000000000000000000000"
+
+
 def state_id_of_type(ds_ids: np.ndarray, state_type: str) -> np.ma.MaskedArray:
     """For an array of dataset IDs look up the corresponding state ID.
 
@@ -89,28 +345,128 @@ def state_id_of_type(ds_ids: np.ndarray, state_type: str) -> np.ma.MaskedArray:
         Array of state IDs. If the ds_id is null, then the entry is masked in the
         output.
     """
-    nulldset = "00000000000000000000000000000000"
+    return state_ids_of_types(ds_ids, [state_type])[state_type]
 
-    unique_ds_ids, ds_index = np.unique(ds_ids, return_inverse=True)
 
-    # Fetch the corresponding state, or return null if the ds was null
-    def _state_or_null(ds_id):
-        if ds_id == nulldset:
-            return nulldset
-        else:
-            return (
-                Dataset.from_id(str(ds_id))
-                .closest_ancestor_of_type(state_type)
-                .state.id
+def state_ids_of_types(ds_ids: np.ndarray, state_types: list) -> dict:
+    """For an array of dataset IDs look up the state IDs of several types at once.
+
+    This is faster than calling `state_id_of_type` for each type, as the ancestors of
+    each unique dataset are only walked once.
+
+    Parameters
+    ----------
+    ds_ids
+        Array of dataset IDs.
+    state_types
+        Names of the dataset state types.
+
+    Returns
+    -------
+    state_ids
+        Array of state IDs for each type name, all with the shape of `ds_ids`. If the
+        ds_id is null, then the entry is masked in the output.
+
+    Raises
+    ------
+    chimedb.core.exceptions.NotFoundError
+        If a dataset has no ancestor of one of the types.
+    """
+    ds_ids = np.asarray(ds_ids)
+
+    # Vectorised lookups if the datasets are indexed in a forest
+    forest = dataset_forest(create=False)
+    if forest is not None:
+        return _state_ids_from_forest(forest, ds_ids, state_types)
+
+    return _state_ids_by_walking(ds_ids, state_types)
+
+
+def _state_ids_from_forest(forest, ds_ids, state_types):
+    """Look up state IDs with the ancestor tables of a forest, without python loops.
+
+    Datasets missing from the forest (or with an incomplete ancestry) are looked up
+    with :func:`_state_ids_by_walking`.
+    """
+    flat_ids = ds_ids.ravel()
+    null = flat_ids == NULL_DATASET
+    pos = forest.positions(flat_ids)
+
+    # state IDs of all datasets with a null state ID at the end
+    strings = np.append(forest.state_id_strings(), NULL_DATASET)
+
+    result = dict()
+    unresolved = np.zeros(len(flat_ids), dtype=bool)
+    for name in state_types:
+        type_id = DatasetStateType.from_name(name).id
+        closest = forest.closest_ancestor_table(type_id)[pos]
+        closest[(pos < 0) | null] = -2
+        missing = (closest == -1) & ~null
+        if missing.any():
+            raise NotFoundError(
+                f"No ancestor of type {name} found for Dataset "
+                f"{flat_ids[missing.argmax()]}"
             )
+        unresolved |= (closest == -2) & ~null
 
-    state_ids = np.array([_state_or_null(ds_id) for ds_id in unique_ds_ids])
+        # state ID of the closest ancestor, null where it's not known (yet)
+        codes = np.where(closest >= 0, forest.state[closest], len(strings) - 1)
+        result[name] = strings[codes]
 
-    masked_ids = np.ma.array(
-        state_ids[ds_index.reshape(ds_ids.shape)],
-        mask=(state_ids == nulldset)[ds_index.reshape(ds_ids.shape)],
-    )
-    return masked_ids
+    if unresolved.any():
+        slow = _state_ids_by_walking(flat_ids[unresolved], state_types)
+        for name, state_ids in result.items():
+            state_ids[unresolved] = slow[name].data
+
+    return {
+        name: np.ma.array(
+            state_ids.reshape(ds_ids.shape), mask=null.reshape(ds_ids.shape)
+        )
+        for name, state_ids in result.items()
+    }
+
+
+def _state_ids_by_walking(ds_ids, state_types):
+    """Look up state IDs by walking up from each unique dataset."""
+    nulldset = NULL_DATASET
+
+    unique_ds_ids, ds_index = np.unique(ds_ids, return_inverse=True)
+    ds_index = ds_index.reshape(ds_ids.shape)
+
+    # Fetch all datasets and their ancestors not cached yet in bulk instead of one query
+    # per dataset
+    prefetch_ancestors([str(ds_id) for ds_id in unique_ds_ids if ds_id != nulldset])
+
+    types = {DatasetStateType.from_name(name).id: name for name in state_types}
+    state_ids = {name: [] for name in state_types}
+
+    # Walk up from each dataset once, collecting the closest state of each type
+    for ds_id in unique_ds_ids:
+        if ds_id == nulldset:
+            for ids in state_ids.values():
+                ids.append(nulldset)
+            continue
+
+        found = dict()
+        d = Dataset.from_id(str(ds_id))
+        while d is not None and len(found) < len(types):
+            name = types.get(d.type_id)
+            if name is not None and name not in found:
+                found[name] = d.state_id
+            d = d.base_dataset
+
+        for name, ids in state_ids.items():
+            if name not in found:
+                raise NotFoundError(
+                    f"No ancestor of type {name} found for Dataset {ds_id}"
+                )
+            ids.append(found[name])
+
+    null = (unique_ds_ids == nulldset)[ds_index]
+    return {
+        name: np.ma.array(np.array(ids)[ds_index], mask=null)
+        for name, ids in state_ids.items()
+    }
 
 
 def unique_unmasked_entry(A: np.ma.MaskedArray, axis: int = -1) -> np.ma.MaskedArray:
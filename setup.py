@@ -13,9 +13,11 @@ setup(
     install_requires=[
         "chimedb @ git+https://github.com/chime-experiment/chimedb.git",
         "click",
+        "numpy",
         "peewee >= 3.10",
         "future",
     ],
+    extras_require={"zstd": ["zstandard"]},
     python_requires=">=3.7",
     author="CHIME collaboration",
     author_email="rick@phas.ubc.ca",
@@ -0,0 +1,76 @@
+"""Test chimedb.dataset.cache."""
+
+import time
+
+from chimedb.dataset.cache import LRUCache
+
+
+def test_max_entries():
+    cache = LRUCache(max_entries=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    # use "a", so that "b" is the least recently used
+    assert cache["a"] == 1
+    cache["c"] = 3
+    assert "b" not in cache
+    assert sorted(cache) == ["a", "c"]
+    assert len(cache) == 2
+
+
+def test_max_bytes():
+    cache = LRUCache(max_bytes=10, sizeof=len)
+    cache["a"] = "12345"
+    cache["b"] = "12345"
+    assert cache.nbytes == 10
+    cache["c"] = "123"
+    assert "a" not in cache
+    assert cache.nbytes == 8
+
+    # an entry bigger than the limit doesn't stay in the cache
+    cache["d"] = "12345678901"
+    assert len(cache) == 0
+    assert cache.nbytes == 0
+
+
+def test_ttl():
+    cache = LRUCache(ttl=0.05)
+    cache["a"] = 1
+    assert cache["a"] == 1
+    time.sleep(0.1)
+    assert "a" not in cache
+    assert cache.get("a") is None
+
+
+def test_configure():
+    cache = LRUCache()
+    for i in range(10):
+        cache[i] = i
+    cache.configure(max_entries=3)
+    assert list(cache) == [7, 8, 9]
+
+
+def test_update():
+    cache = LRUCache(max_entries=3, max_bytes=8, sizeof=len)
+    cache["a"] = "1"
+    cache.update({"b": "12", "a": "123", "c": "1"})
+    assert cache.nbytes == 6
+    assert cache.get("b") == "12"
+    assert cache.get("d", 0) == 0
+
+    # the least recently used entries are evicted like inserting one by one
+    cache.update({"d": "1", "e": "1"})
+    assert sorted(cache) == ["b", "d", "e"]
+    assert cache.nbytes == 4
+
+
+def test_peek():
+    cache = LRUCache(max_entries=2, ttl=0.05)
+    cache["a"] = 1
+    cache["b"] = 2
+    # doesn't mark "a" as recently used
+    assert cache.peek("a") == 1
+    assert cache.peek("x", 0) == 0
+    cache["c"] = 3
+    assert cache.peek("a") is None
+    time.sleep(0.1)
+    assert cache.peek("c", 0) == 0
@@ -2,9 +2,15 @@
 
 import chimedb.dataset.get as dget
 import chimedb.dataset.orm as orm
-from chimedb.dataset.testing import TestChimeDB
+from chimedb.dataset.testing import QueryCounter, TestChimeDB
+from chimedb.core.exceptions import NotFoundError
 
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import logging
+import os
+import tempfile
+import time
 from peewee import DoesNotExist
 
 
@@ -106,3 +112,450 @@ class TestDataset(TestChimeDB):
         # pre-fetch
         dget.index()
         tests()
+
+    def test_from_ids(self):
+        def tests():
+            ds = dget.Dataset.from_ids(["1338", "unknown", "1337"])
+            assert len(ds) == 3
+            assert ds[0].id == "1338"
+            assert ds[1] is None
+            assert ds[2].id == "1337"
+            assert "1337" in dget._dataset_cache
+
+            states = dget.DatasetState.from_ids(["24", "unknown", "23"])
+            assert [s.id if s else None for s in states] == ["24", None, "23"]
+            assert states[0].data == {"twenty": 4}
+
+        # from the database
+        dget._dataset_cache.clear()
+        dget._state_cache.clear()
+        tests()
+
+        # from the cache
+        tests()
+
+    def test_lineage(self):
+        def tests():
+            lineage = dget.Dataset.lineage("1338")
+            assert [d.id for d in lineage] == ["1338", "1337"]
+            assert lineage[0].base_dataset is lineage[1]
+            assert lineage[0].type.name == "twentyfour"
+            assert "24" in dget._state_cache
+            assert "twentythree" in dget._type_cache
+
+            assert dget.Dataset.lineage("unknown") is None
+
+        # from the database
+        dget._dataset_cache.clear()
+        dget._state_cache.clear()
+        dget._type_cache.clear()
+        dget._type_cache_by_id.clear()
+        tests()
+
+        # from the cache
+        tests()
+
+    def test_bounded_cache(self):
+        dget.configure_cache(max_datasets=1)
+        try:
+            dget.index()
+            assert len(dget._dataset_cache) == 1
+
+            ds = dget.Dataset.from_id("1338")
+            assert ds.base_dataset.id == "1337"
+            assert dget.Dataset.from_id("1337").id == "1337"
+            assert len(dget.DatasetCache()) == 1
+        finally:
+            dget.configure_cache()
+
+    def test_concurrent_from_id(self):
+        dget._dataset_cache.clear()
+        dget._state_cache.clear()
+
+        def resolve(i):
+            if i % 2:
+                return dget.Dataset.from_id("1338")
+            return dget.Dataset.from_ids(["1338", "1337"])[0]
+
+        with QueryCounter(delay=0.05) as counter:
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                results = list(pool.map(resolve, range(64)))
+
+        assert all(ds is results[0] for ds in results)
+        assert 1 <= counter.count("dataset") <= 2
+
+        with QueryCounter() as counter:
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                states = list(pool.map(dget.DatasetState.from_id, ["24"] * 64))
+                list(pool.map(lambda _: dget.index(), range(4)))
+        assert all(s.id == "24" for s in states)
+        assert counter.count("datasetstate") <= 1
+
+    def test_index_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "index.snap")
+
+            # no snapshot yet: index from DB and write it
+            dget.index(snapshot=path)
+            assert os.path.isfile(path)
+
+            # insert a dataset newer than the snapshot
+            orm.Dataset.get_or_create(
+                id="1339",
+                root=False,
+                state="23",
+                time=datetime.datetime.now(),
+                base_dset="1338",
+            )
+
+            dget._dataset_cache.clear()
+            dget._state_cache.clear()
+            with QueryCounter() as counter:
+                dget.index(snapshot=path)
+            assert counter.count("dataset") == 1
+
+            ds = dget.Dataset.from_id("1339")
+            assert ds.base_dataset.id == "1338"
+            assert ds.base_dataset.base_dataset.id == "1337"
+            assert ds.closest_ancestor_of_type("twentyfour").id == "1338"
+            assert (
+                repr(dget.Dataset.from_id("1337")) == "<get.Dataset[twentythree]: 1337>"
+            )
+
+            # a corrupt snapshot is ignored and replaced
+            with open(path, "wb") as f:
+                f.write(b"garbage")
+            dget.index(snapshot=path)
+            assert "1339" in dget._dataset_cache
+            with open(path, "rb") as f:
+                assert f.read(8) == b"CHDSSNAP"
+
+    def test_refresh(self):
+        dget.index()
+        assert dget._watermark is not None
+
+        orm.Dataset.get_or_create(
+            id="1340",
+            root=False,
+            state="24",
+            time=datetime.datetime.now(),
+            base_dset="1337",
+        )
+        assert "1340" not in dget._dataset_cache
+
+        refresher = dget.start_refresher(interval=0.01)
+        try:
+            for _ in range(100):
+                if "1340" in dget._dataset_cache:
+                    break
+                time.sleep(0.01)
+        finally:
+            refresher.stop()
+        assert not refresher.is_alive()
+
+        ds = dget._dataset_cache["1340"]
+        assert ds.base_dataset is dget._dataset_cache["1337"]
+        assert ds.type.name == "twentyfour"
+
+        # only the new rows are fetched
+        with QueryCounter() as counter:
+            dget.refresh()
+        assert counter.count("dataset") == 1
+        assert counter.count("datasetstate") == 1
+
+    def test_refresh_unchanged(self):
+        dget.index()
+        ds = dget.Dataset.from_id("1338")
+        ds.closest_ancestor_of_type("twentythree")
+        remembered = len(dget._closest_cache)
+        assert remembered
+
+        # nothing new: the caches are kept
+        dget.refresh()
+        assert dget._dataset_cache["1338"] is ds
+        assert len(dget._closest_cache) == remembered
+
+        dget.precompute_ancestors(["twentythree"])
+        try:
+            cache_forest = dget._cache_forest
+            dget.refresh()
+            assert dget._cache_forest is cache_forest
+
+            # new datasets extend the ancestor tables
+            orm.Dataset.get_or_create(
+                id="1341",
+                root=False,
+                state="24",
+                time=datetime.datetime.now(),
+                base_dset="1338",
+            )
+            dget.refresh()
+            assert dget._cache_forest is not cache_forest
+            assert dget.Dataset.from_id("1341").base_dataset is ds
+            assert len(dget._closest_cache) == remembered
+            type_id = dget.DatasetStateType.from_name("twentythree").id
+            assert type_id in dget._cache_forest._tables
+            closest = dget.Dataset.from_id("1341").closest_ancestor_of_type(
+                "twentythree"
+            )
+            assert closest.id == "1337"
+        finally:
+            dget._cache_forest = None
+            dget._ancestor_tables_enabled = False
+
+        dget.index(compact=True)
+        try:
+            forest = dget._forest
+            dget.refresh()
+            assert dget._forest is forest
+        finally:
+            dget.index(compact=False)
+
+    def test_deferred_data(self):
+        dget._state_cache.clear()
+
+        state = dget.DatasetState.from_id("24", load_data=False)
+        assert state.id == "24"
+        assert state.state_type.name == "twentyfour"
+        assert not state.data_loaded
+        assert dget._state_cache["24"] is state
+
+        # states loaded separately have their data loaded separately
+        other = dget.DatasetState.from_ids(["23"], load_data=False)[0]
+        with QueryCounter() as counter:
+            assert state.data == {"twenty": 4}
+        assert counter.count("datasetstate") == 1
+        assert state.data_loaded
+        assert not other.data_loaded
+
+        # load_data=True upgrades the cached entry
+        assert dget.DatasetState.from_id("23") is other
+        assert other.data_loaded
+        assert other.data == {"twenty": 3}
+
+        # data of deferred states loaded together is fetched together
+        dget._state_cache.clear()
+        states = dget.DatasetState.from_ids(["23", "24"], load_data=False)
+        with QueryCounter() as counter:
+            assert states[1].data == {"twenty": 4}
+            assert states[0].data == {"twenty": 3}
+        assert counter.count("datasetstate") == 1
+
+    def test_precompute_ancestors(self):
+        dget.index()
+        dget.precompute_ancestors()
+        try:
+            forest = dget._cache_forest
+            assert forest is not None
+            assert len(forest._tables) == len(dget._type_cache_by_id)
+
+            ds = dget.Dataset.from_id("1338")
+            assert ds.closest_ancestor_of_type("twentyfour") is ds
+            assert ds.closest_ancestor_of_type("twentythree").id == "1337"
+            try:
+                dget.Dataset.from_id("1337").closest_ancestor_of_type("twentyfour")
+            except NotFoundError:
+                pass
+            else:
+                assert False, "Expected NotFoundError"
+
+            # tables are rebuilt after the cache changed
+            dget.index()
+            assert dget._cache_forest is None
+            ds = dget.Dataset.from_id("1338")
+            assert ds.closest_ancestor_of_type("twentythree").id == "1337"
+            assert dget._cache_forest is not None
+        finally:
+            dget._ancestor_tables_enabled = False
+            dget._cache_forest = None
+
+    def test_type_id(self):
+        type24 = dget.DatasetStateType.from_name("twentyfour").id
+
+        dget._dataset_cache.clear()
+        dget.index()
+        assert dget._dataset_cache["1338"]._type_id == type24
+
+        dget.index(compact=True)
+        try:
+            dget._dataset_cache.clear()
+            assert dget.Dataset.from_id("1338")._type_id == type24
+        finally:
+            dget.index(compact=False)
+
+        # looked up if the dataset wasn't indexed
+        ds = dget.Dataset.get(dget.Dataset.id == "1338")
+        assert ds._type_id is None
+        assert ds.type_id == type24
+
+    def test_closest_ancestor_memo(self):
+        dget.index()
+        type23 = dget.DatasetStateType.from_name("twentythree").id
+        type24 = dget.DatasetStateType.from_name("twentyfour").id
+
+        ds = dget.Dataset.from_id("1338")
+        assert ds.closest_ancestor_of_type("twentythree").id == "1337"
+        # remembered for every dataset on the way
+        assert dget._closest_cache[("1338", type23)] == "1337"
+        assert dget._closest_cache[("1337", type23)] == "1337"
+
+        with self.assertRaises(NotFoundError):
+            dget.Dataset.from_id("1337").closest_ancestor_of_type("twentyfour")
+        assert dget._closest_cache[("1337", type24)] is None
+
+        # later lookups stop at the remembered answer
+        dget._closest_cache[("1338", type23)] = "1338"
+        assert ds.closest_ancestor_of_type("twentythree") is ds
+
+        dget.index()
+        assert len(dget._closest_cache) == 0
+        assert ds.closest_ancestor_of_type("twentythree").id == "1337"
+
+        dget.configure_cache(max_ancestors=1)
+        try:
+            ds.closest_ancestor_of_type("twentythree")
+            assert len(dget._closest_cache) == 1
+        finally:
+            dget.configure_cache()
+
+    def test_compact_index(self):
+        dget._dataset_cache.clear()
+        dget.index(compact=True)
+        try:
+            assert len(dget._dataset_cache) == 0
+            forest = dget.dataset_forest()
+            assert forest is dget._forest
+            assert forest.position("1338") >= 0
+
+            cache = dget.DatasetCache()
+            assert len(cache) == len(forest)
+            assert "1338" in set(cache)
+
+            # Dataset objects are created on demand, without querying the database
+            with QueryCounter() as counter:
+                ds = cache["1338"]
+                assert ds.base_dataset.id == "1337"
+                assert repr(ds) == "<get.Dataset[twentyfour]: 1338>"
+                assert ds.closest_ancestor_of_type("twentythree").id == "1337"
+            assert counter.count("dataset", where=False) == 0
+            assert dget._dataset_cache["1338"] is ds
+
+            assert forest.tree_size(forest.position("1338")) >= 2
+        finally:
+            dget.index(compact=False)
+
+        # compact=False switches back to Dataset objects
+        assert dget._forest is None
+        assert dget._dataset_cache["1338"].base_dataset.id == "1337"
+
+    def test_stream_index(self):
+        class PeakRSS(logging.Handler):
+            def emit(self, record):
+                self.peak_rss = getattr(record, "peak_rss", None)
+
+        handler = PeakRSS(logging.DEBUG)
+        logger = logging.getLogger("chimedb")
+        level = logger.level
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        try:
+            dget._dataset_cache.clear()
+            dget.index(chunk_size=1)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        assert handler.peak_rss > 0
+        ds = dget._dataset_cache["1338"]
+        assert ds.base_dataset is dget._dataset_cache["1337"]
+        assert ds.closest_ancestor_of_type("twentythree").id == "1337"
+
+    def test_children(self):
+        def tests():
+            ds = dget.Dataset.from_id("1337")
+            assert "1338" in [c.id for c in ds.children]
+            assert "1338" in [d.id for d in ds.descendants()]
+            assert dget.Dataset.from_id("1338").children == []
+
+        dget.index()
+        tests()
+
+        # the children are replaced rather than changed while other threads may read
+        children = dget._children["1337"]
+        assert isinstance(children, tuple)
+        d = dget.Dataset(id="1339", root=False, state="24", time=None, base_dset="1337")
+        dget._publish({"1339": d}, {}, {})
+        try:
+            assert "1339" not in children
+            assert dget._children["1337"] == children + ("1339",)
+            # publishing a child again doesn't repeat it
+            dget._publish({"1339": d}, {}, {})
+            assert dget._children["1337"] == children + ("1339",)
+        finally:
+            dget._dataset_cache.pop("1339")
+            dget._children["1337"] = children
+
+        dget.index(compact=True)
+        try:
+            tests()
+        finally:
+            dget.index(compact=False)
+
+    def test_compressed_data(self):
+        data = {"freq": list(range(1000))}
+        orm.configure_compression("zlib", min_size=100)
+        try:
+            orm.DatasetState.create(
+                id="compressed", type=None, data=data, time=datetime.datetime.now()
+            )
+            orm.DatasetState.create(
+                id="small", type=None, data={"a": 1}, time=datetime.datetime.now()
+            )
+        finally:
+            orm.configure_compression(None)
+
+        def raw(state_id):
+            query = orm.DatasetState.select(orm.DatasetState.data).where(
+                orm.DatasetState.id == state_id
+            )
+            return orm.DatasetState._meta.database.execute_sql(*query.sql()).fetchone()[
+                0
+            ]
+
+        assert orm.is_compressed(raw("compressed"))
+        assert not orm.is_compressed(raw("small"))
+        assert dget.DatasetState.from_id("compressed").data == data
+        assert dget.DatasetState.from_id("small").data == {"a": 1}
+
+    def test_extract(self):
+        orm.DatasetState.create(
+            id="extract",
+            type=None,
+            data={"freq": [[1, {"a b": "x"}]], "n": 2, "none": None},
+            time=datetime.datetime.now(),
+        )
+        orm.configure_compression("zlib", min_size=0)
+        try:
+            orm.DatasetState.create(
+                id="extract_z", type=None, data={"n": 3}, time=datetime.datetime.now()
+            )
+        finally:
+            orm.configure_compression(None)
+        dget._state_cache.clear()
+
+        ids = ["extract", "extract_z", "unknown"]
+        assert dget.DatasetState.extract(ids, "$.n") == {
+            "extract": 2,
+            "extract_z": 3,
+            "unknown": None,
+        }
+        assert dget.DatasetState.extract(ids, '$.freq[0][1]."a b"')["extract"] == "x"
+        assert dget.DatasetState.extract(ids, "$.freq[1]")["extract"] is None
+        assert dget.DatasetState.extract(ids, "$")["extract"]["n"] == 2
+
+        # only the compressed state was loaded, the other one is extracted in the DB
+        assert "extract_z" in dget._state_cache
+        assert "extract" not in dget._state_cache
+
+        with self.assertRaises(ValueError):
+            dget.DatasetState.extract(ids, "$.freq[*]")
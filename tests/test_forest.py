@@ -0,0 +1,196 @@
+"""Test chimedb.dataset.forest.DatasetForest."""
+
+import datetime
+import os
+import tempfile
+
+import numpy as np
+
+from chimedb.dataset.forest import DatasetForest, UNKNOWN_PARENT
+
+
+def make_forest():
+    """Create a forest with two trees.
+
+    a (t1) - b (t2) - c (t1)
+                    \\ d (t3)
+    e (t2) - f (t1)
+    """
+    time = datetime.datetime(2020, 1, 1)
+    return DatasetForest.build(
+        ids=["a", "b", "c", "d", "e", "f"],
+        base_ids=["", "a", "b", "b", "", "e"],
+        root=[True, False, False, False, True, False],
+        time=[time + datetime.timedelta(seconds=i) for i in range(6)],
+        ds_state_ids=["s1", "s2", "s1", "s3", "s2", "s1"],
+        ds_type_ids=[1, 2, 1, 3, 2, 1],
+        types={1: "t1", 2: "t2", 3: "t3"},
+    )
+
+
+def test_build():
+    forest = make_forest()
+    assert len(forest) == 6
+    assert list(forest.positions(["c", "x", "a"])) == [2, -1, 0]
+    assert forest.position("f") == 5
+    assert forest.id(1) == "b"
+    assert forest.base_id(2) == "b"
+    assert forest.base_id(0) is None
+    assert forest.state_id(5) == "s1"
+    assert list(forest.type_id) == [1, 2, 1, 3, 2, 1]
+    assert forest.watermark == datetime.datetime(2020, 1, 1, 0, 0, 5)
+
+
+def test_positions_exact():
+    time = datetime.datetime(2020, 1, 1)
+    full = "a" * 32
+    forest = DatasetForest.build(
+        ids=[full, "abc"],
+        base_ids=["", ""],
+        root=[True, True],
+        time=[time] * 2,
+        ds_state_ids=["s1", "s2"],
+        ds_type_ids=[1, 1],
+        types={1: "t1"},
+    )
+    # prefixes, longer IDs and non-ASCII IDs are not found
+    queries = ["aaaa", full, full + "a", "ab", "abc", "abcd", "abcé"]
+    assert list(forest.positions(queries)) == [-1, 0, -1, -1, 1, -1, -1]
+    assert list(forest.positions(np.array(queries[:2], dtype="S"))) == [-1, 0]
+    assert forest.position("aaa") == -1
+
+
+def test_closest_ancestor_table():
+    forest = make_forest()
+    assert list(forest.closest_ancestor_table(1)) == [0, 0, 2, 0, -1, 5]
+    assert list(forest.closest_ancestor_table(2)) == [-1, 1, 1, 1, 4, 4]
+    assert list(forest.closest_ancestor_table(3)) == [-1, -1, -1, 3, -1, -1]
+
+
+def test_tree_size():
+    forest = make_forest()
+    assert list(forest.roots()) == [0, 0, 0, 0, 4, 4]
+    assert forest.tree_size(3) == 4
+    assert forest.tree_size(4) == 2
+
+
+def test_children():
+    forest = make_forest()
+    assert list(forest.children(0)) == [1]
+    assert list(forest.children(1)) == [2, 3]
+    assert list(forest.children(2)) == []
+    assert forest.root_of(3) == 0
+    assert [list(level) for level in forest.levels(0)] == [[0], [1], [2, 3]]
+    assert [list(level) for level in forest.levels(5)] == [[5]]
+
+
+def test_merge():
+    forest = make_forest()
+    time = datetime.datetime(2020, 1, 2)
+    new = DatasetForest.build(
+        ids=["g", "f"],
+        base_ids=["c", "e"],
+        root=[False, False],
+        time=[time, time],
+        ds_state_ids=["s4", "s1"],
+        ds_type_ids=[4, 1],
+        types={4: "t4"},
+    )
+    assert new.parent[0] == UNKNOWN_PARENT
+    assert new.unresolved == {0: "c", 1: "e"}
+    assert list(new.closest_ancestor_table(1)) == [-2, 1]
+
+    merged = forest.merge(new)
+    assert len(merged) == 7
+    assert not merged.unresolved
+    g = merged.position("g")
+    assert merged.base_id(g) == "c"
+    assert merged.closest_ancestor_table(1)[g] == merged.position("c")
+    assert merged.types[4] == "t4"
+    assert merged.watermark == time
+
+
+def test_extend():
+    forest = make_forest()
+    table = forest.closest_ancestor_table(1)
+    assert forest.extend(forest) is forest
+
+    time = datetime.datetime(2020, 1, 2)
+    new = DatasetForest.build(
+        ids=["g", "f", "h"],
+        base_ids=["c", "e", "g"],
+        root=[False, False, False],
+        time=[time] * 3,
+        ds_state_ids=["s4", "s1", "s2"],
+        ds_type_ids=[4, 1, 2],
+        types={4: "t4"},
+    )
+    extended = forest.extend(new)
+    assert len(extended) == 8
+    assert [extended.id(i) for i in (6, 7)] == ["g", "h"]
+    # the table is extended rather than computed again
+    assert 1 in extended._tables
+    assert list(extended.closest_ancestor_table(1)) == list(table) + [2, 2]
+    assert list(extended.closest_ancestor_table(1)) == list(
+        make_forest().extend(new).closest_ancestor_table(1)
+    )
+
+    # a new base dataset changes the closest ancestors of its children
+    orphan = DatasetForest.build(
+        ids=["i"],
+        base_ids=["j"],
+        root=[False],
+        time=[time],
+        ds_state_ids=["s1"],
+        ds_type_ids=[1],
+        types={1: "t1"},
+    )
+    assert list(orphan.closest_ancestor_table(2)) == [-2]
+    base = DatasetForest.build(
+        ids=["j"],
+        base_ids=[""],
+        root=[True],
+        time=[time],
+        ds_state_ids=["s2"],
+        ds_type_ids=[2],
+        types={2: "t2"},
+    )
+    extended = orphan.extend(base)
+    assert not extended._tables
+    assert list(extended.closest_ancestor_table(2)) == [1, 1]
+
+
+def test_save_load():
+    forest = make_forest()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "forest.snap")
+        forest.save(path)
+        loaded = DatasetForest.load(path)
+        assert isinstance(loaded.ids, np.memmap)
+        assert list(loaded.ids) == list(forest.ids)
+        assert list(loaded.parent) == list(forest.parent)
+        assert loaded.types == forest.types
+        assert loaded.watermark == forest.watermark
+        assert list(loaded.closest_ancestor_table(1)) == [0, 0, 2, 0, -1, 5]
+
+
+def test_save_load_unresolved():
+    time = datetime.datetime(2020, 1, 1)
+    forest = DatasetForest.build(
+        ids=["x", "y", "z"],
+        base_ids=["a", "x", "b"],
+        root=[False, False, False],
+        time=[time] * 3,
+        ds_state_ids=["s1", "s2", "s1"],
+        ds_type_ids=[1, 2, 1],
+        types={1: "t1", 2: "t2"},
+    )
+    assert forest.unresolved == {0: "a", 2: "b"}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "forest.snap")
+        forest.save(path)
+        loaded = DatasetForest.load(path)
+        assert loaded.unresolved == forest.unresolved
+        assert loaded.base_id(0) == "a"
+        assert loaded.base_id(1) == "x"
+        assert list(loaded.closest_ancestor_table(2)) == [-2, 1, -2]
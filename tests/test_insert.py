@@ -0,0 +1,173 @@
+"""Test chimedb.dataset.insert."""
+
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import math
+import time
+
+import peewee
+
+import chimedb.dataset.get as dget
+import chimedb.dataset.orm as orm
+from chimedb.dataset import insert
+from chimedb.dataset.testing import QueryCounter, TestChimeDB
+
+
+class TestInsert(TestChimeDB):
+    """Test using test_enable() for testing"""
+
+    def test_insert_many(self):
+        now = datetime.datetime.now()
+        states = [
+            ("b1", "bulk_a", now, {"a": 1}),
+            {"state_id": "b2", "state_type": "bulk_b", "time": now, "state": {}},
+            ("b1", "bulk_a", now, {"a": 1}),
+        ]
+        assert insert.insert_states(states) == (2, 1)
+        assert insert.insert_states(states) == (0, 3)
+        assert orm.DatasetState.get(id="b2").type.name == "bulk_b"
+        assert orm.DatasetState.get(id="b1").data == {"a": 1}
+
+        # children before their base datasets
+        datasets = [
+            ("bd3", "bd2", False, "b2", now),
+            ("bd2", "bd1", False, "b1", now),
+            ("bd1", None, True, "b1", now),
+        ]
+        assert insert.insert_datasets(datasets) == (3, 0)
+        assert orm.Dataset.get(id="bd3").base_dset.id == "bd2"
+        assert insert.insert_datasets(datasets[:1]) == (0, 1)
+
+        # unknown state: nothing is inserted
+        datasets = [("bd4", "bd1", False, "b1", now), ("bd5", "bd4", False, "x", now)]
+        with self.assertRaises(orm.DatasetState.DoesNotExist):
+            insert.insert_datasets(datasets)
+        assert not orm.Dataset.select().where(orm.Dataset.id == "bd4").exists()
+
+    def test_insert_queue(self):
+        now = datetime.datetime.now()
+        with insert.InsertQueue(max_batch=10, max_age=0.05, retry_delay=0.01) as q:
+            # dataset before its state and base dataset
+            q.put_dataset("qd2", "qd1", False, "q1", now)
+            q.put_state("q1", "queued", now, {"q": 1})
+            assert not q.flush()
+            assert q.depth == 1
+            assert not orm.Dataset.select().where(orm.Dataset.id == "qd2").exists()
+
+            q.put_dataset("qd1", None, True, "q1", now)
+            assert q.flush()
+            assert orm.Dataset.get(id="qd2").base_dset.id == "qd1"
+
+            # flushed because of their age
+            q.put_state("q2", "queued", now, {"q": 2})
+            time.sleep(0.5)
+            assert orm.DatasetState.get(id="q2").data == {"q": 2}
+
+            # transient errors are retried
+            insert_states = insert.insert_states
+            errors = [peewee.OperationalError("gone away")]
+
+            def failing_insert_states(states):
+                if errors:
+                    raise errors.pop()
+                return insert_states(states)
+
+            insert.insert_states = failing_insert_states
+            try:
+                q.put_state("q3", "queued", now, {"q": 3})
+                assert q.flush()
+            finally:
+                insert.insert_states = insert_states
+            assert orm.DatasetState.select().where(orm.DatasetState.id == "q3").exists()
+
+        stats = q.stats()
+        assert stats["states_inserted"] == 3
+        assert stats["datasets_inserted"] == 2
+        assert stats["retries"] == 1
+        assert stats["depth"] == 0
+        assert stats["max_flush_latency"] > 0
+
+    def test_type_cache(self):
+        now = datetime.datetime.now()
+        names = [f"concurrent_{i % 3}" for i in range(30)]
+        with ThreadPoolExecutor(8) as pool:
+            ids = list(pool.map(lambda n: insert._resolve_types([n])[n], names))
+        for name in set(names):
+            assert (
+                orm.DatasetStateType.select()
+                .where(orm.DatasetStateType.name == name)
+                .count()
+                == 1
+            )
+            assert dget.DatasetStateType.from_name(name).id == ids[names.index(name)]
+
+        # Known types are not queried again
+        with QueryCounter() as counter:
+            insert.insert_state("tc1", "concurrent_0", now, {})
+        assert counter.count("datasetstatetype", where=False) == 0
+        assert orm.DatasetState.get(id="tc1").type.name == "concurrent_0"
+
+    def test_insert_single(self):
+        now = datetime.datetime.now()
+        insert.insert_state("s1", "single", now, {"s": 1})
+        insert.insert_dataset("sd1", None, True, "s1", now)
+
+        # Existing rows are skipped with a single statement each
+        with QueryCounter() as counter:
+            insert.insert_state("s1", "single", now, {"s": 1})
+            insert.insert_dataset("sd1", None, True, "s1", now)
+        assert len(counter.queries) == 2
+        assert orm.DatasetState.get(id="s1").data == {"s": 1}
+
+        with self.assertRaises(orm.DatasetState.DoesNotExist):
+            insert.insert_dataset("sd2", "sd1", False, "unknown", now)
+        with self.assertRaises(orm.Dataset.DoesNotExist):
+            insert.insert_dataset("sd2", "unknown", False, "s1", now)
+        insert.insert_dataset("sd2", "sd1", False, "s1", now)
+        assert orm.Dataset.get(id="sd2").base_dset.id == "sd1"
+
+    def test_insert_invalid_rows(self):
+        now = datetime.datetime.now()
+        insert.insert_states([("iv1", "invalid", now, {"a": 1})])
+        # only existing IDs are skipped, other constraint violations raise
+        with self.assertRaises(peewee.IntegrityError):
+            insert.insert_states([("iv2", "invalid", None, {"a": 1})])
+        with self.assertRaises(peewee.IntegrityError):
+            insert.insert_datasets([("ivd", None, None, "iv1", now)])
+        assert insert.insert_states([("iv1", "invalid", now, {"a": 1})]).skipped == 1
+
+    def test_non_finite_floats(self):
+        data = {"nan": float("nan"), "inf": float("inf"), "-inf": -float("inf")}
+        insert.insert_state("nf1", "non_finite", datetime.datetime.now(), data)
+        previous = orm.json_codec()
+        for name in orm.JSON_CODECS:
+            try:
+                orm.set_json_codec(name)
+            except ImportError:
+                continue
+            try:
+                read = orm.DatasetState.get(id="nf1").data
+            finally:
+                orm._codec = previous
+            assert math.isnan(read["nan"])
+            assert read["inf"] == float("inf") and read["-inf"] == -float("inf")
+
+    def test_dedup(self):
+        now = datetime.datetime.now()
+        data = {"flags": list(range(100))}
+        insert.configure_dedup(min_size=100)
+        try:
+            insert.insert_states([(f"dd{i}", "dedup", now, data) for i in range(3)])
+            insert.insert_state("dd3", "dedup", now, {"small": 1})
+        finally:
+            insert.configure_dedup(False)
+
+        assert orm.DatasetStatePayload.select().count() == 1
+        payload = orm.DatasetStatePayload.get()
+        assert payload.hash == orm.payload_hash(data)
+
+        dget._state_cache.clear()
+        states = dget.DatasetState.from_ids([f"dd{i}" for i in range(4)])
+        assert states[0].data == data
+        assert states[0].data is states[2].data
+        assert states[3].data == {"small": 1}
@@ -0,0 +1,22 @@
+"""Test chimedb.dataset.orm."""
+
+import pytest
+
+from chimedb.dataset import orm
+
+
+@pytest.mark.parametrize("name", list(orm.JSON_CODECS))
+def test_json_codec(name):
+    previous = orm.json_codec()
+    try:
+        codec = orm.set_json_codec(name)
+    except ImportError:
+        pytest.skip(f"{name} not installed")
+    try:
+        field = orm.DatasetState.data
+        data = {"freq": [[400.0, 0.39]], "1": None, "nested": {"a": "b"}}
+        assert field.python_value(field.db_value(data)) == data
+        assert field.python_value(field.db_value(data).encode()) == data
+        assert codec.loads('{"nan": NaN}')["nan"] != 0.0
+    finally:
+        orm._codec = previous
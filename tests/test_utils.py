@@ -0,0 +1,107 @@
+"""Test chimedb.dataset.utils."""
+
+import datetime
+
+import numpy as np
+
+import chimedb.dataset.get as dget
+import chimedb.dataset.orm as orm
+from chimedb.dataset import insert, utils
+from chimedb.dataset.testing import QueryCounter, TestChimeDB
+from chimedb.core.exceptions import NotFoundError
+
+NULL = "00000000000000000000000000000000"
+
+
+class TestStateIdOfType(TestChimeDB):
+    """Test using test_enable() for testing"""
+
+    def setUp(self):
+        super().setUp()
+        if orm.Dataset.select().where(orm.Dataset.id == "ut_a").exists():
+            return
+
+        # ut_a (freq) - ut_b (inputs) - ut_c (freq)
+        #                             \\ ut_d (flags)
+        now = datetime.datetime.now()
+        insert.insert_states(
+            [
+                ("ut_f1", "ut_freq", now, {"f": 1}),
+                ("ut_i", "ut_inputs", now, {"i": 1}),
+                ("ut_f2", "ut_freq", now, {"f": 2}),
+                ("ut_fl", "ut_flags", now, {"fl": 1}),
+            ]
+        )
+        insert.insert_datasets(
+            [
+                ("ut_a", None, True, "ut_f1", now),
+                ("ut_b", "ut_a", False, "ut_i", now),
+                ("ut_c", "ut_b", False, "ut_f2", now),
+                ("ut_d", "ut_b", False, "ut_fl", now),
+            ]
+        )
+
+    def test_state_ids_of_types(self):
+        ds_ids = np.array([["ut_c", "ut_d"], [NULL, "ut_c"]])
+        result = utils.state_ids_of_types(ds_ids, ["ut_freq", "ut_inputs"])
+
+        freq = result["ut_freq"]
+        assert freq.shape == (2, 2)
+        assert list(freq.mask.ravel()) == [False, False, True, False]
+        assert list(freq.compressed()) == ["ut_f2", "ut_f1", "ut_f2"]
+        assert list(result["ut_inputs"].compressed()) == ["ut_i"] * 3
+
+        single = utils.state_id_of_type(ds_ids, "ut_freq")
+        assert (single == freq).all()
+
+        with self.assertRaises(NotFoundError):
+            utils.state_ids_of_types(ds_ids, ["ut_flags"])
+
+    def test_state_ids_from_forest(self):
+        ds_ids = np.array([["ut_c", "ut_d"], [NULL, "ut_b"]])
+        slow = utils.state_ids_of_types(ds_ids, ["ut_freq", "ut_inputs"])
+
+        dget.index(compact=True)
+        try:
+            assert dget.dataset_forest(create=False) is dget._forest
+            fast = utils.state_ids_of_types(ds_ids, ["ut_freq", "ut_inputs"])
+
+            # a dataset that isn't indexed yet is looked up in the database
+            now = datetime.datetime.now()
+            insert.insert_dataset("ut_e", "ut_d", False, "ut_i", now)
+            new = utils.state_id_of_type(np.array(["ut_e", "ut_c"]), "ut_inputs")
+
+            # a prefix of an indexed ID is not that dataset
+            with self.assertRaises(NotFoundError):
+                utils.state_id_of_type(np.array(["ut_"]), "ut_inputs")
+            assert dget.Dataset.from_id("ut_") is None
+        finally:
+            dget.index(compact=False)
+
+        for name in slow:
+            assert (fast[name].mask == slow[name].mask).all()
+            assert (fast[name] == slow[name]).all()
+        assert list(new) == ["ut_i", "ut_i"]
+
+    def test_state_id_of_type_skips_payloads(self):
+        dget._dataset_cache.clear()
+        dget._state_cache.clear()
+
+        ds_ids = np.array(["ut_c", "ut_d", NULL])
+        with QueryCounter() as counter:
+            freq = utils.state_id_of_type(ds_ids, "ut_freq")
+        assert list(freq.compressed()) == ["ut_f2", "ut_f1"]
+
+        # states are only needed for their type, never for their data
+        payloads = [
+            sql
+            for sql, _ in counter.queries
+            if '"datasetstate"' in sql and '"data"' in sql
+        ]
+        assert payloads == []
+
+        # the ID of the state is available without any query
+        d = dget.Dataset.from_id("ut_c")
+        with QueryCounter() as counter:
+            assert d.state_id == "ut_f2"
+        assert counter.queries == []